@@ -68,6 +68,7 @@ def main():
     print(f"Resume: {not args.no_resume}")
     print("=" * 50)
     
+    db = None
     try:
         # 1. Initialize API client
         print("[INIT] Connecting to J-Quants API...")
@@ -94,6 +95,9 @@ def main():
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if db is not None:
+            db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,22 @@
+"""
+Numba JITデコレータのフォールバック
+
+numbaがインストールされていればそのまま `njit` / `prange` を返し、
+無い環境では何もしないデコレータと `range` で代替する（純Pythonとして動作）。
+"""
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """numba未インストール時のダミーデコレータ"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        def decorator(func):
+            return func
+        return decorator
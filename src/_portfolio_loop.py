@@ -0,0 +1,149 @@
+"""
+PortfolioBacktester.run_simulation 用の日次シミュレーションループ
+
+(日付, 銘柄) の2次元配列を受け取り、資金・保有ポジションを日ごとに更新する。
+ポジションは MAX_POSITIONS 個のスロット配列で管理する（-1 = 空き）。
+numbaがあればネイティブコードで実行される。
+"""
+
+import numpy as np
+
+from src._njit import njit
+
+
+@njit(cache=True)
+def _simulate(close, high, low, present, sentiment, entry_sig, priority,
+              stop_pct, trail_pct, bullish_threshold, max_pos, cash0):
+    """
+    ポートフォリオシミュレーション本体
+
+    Args:
+        close, high, low: 価格配列 (T, C)
+        present: その日に銘柄の行が存在するか (T, C)
+        sentiment: 日ごとの市場センチメント（上昇トレンド銘柄の比率） (T,)
+        entry_sig: エントリーシグナル (T, C)
+        priority: 優先順位スコア（小さいほど優先） (T, C)
+        stop_pct: 損切り率
+        trail_pct: トレーリングストップ率
+        bullish_threshold: 新規エントリーを許可する市場センチメントの下限
+        max_pos: 最大保有銘柄数
+        cash0: 初期資金
+
+    Returns:
+        (equity, tr_code, tr_entry_t, tr_exit_t, tr_profit, tr_return)
+    """
+    n_days, n_codes = close.shape
+
+    # ポジション（スロット単位）
+    pos_code = np.full(max_pos, -1, dtype=np.int64)
+    pos_entry_px = np.zeros(max_pos, dtype=np.float64)
+    pos_high_px = np.zeros(max_pos, dtype=np.float64)
+    pos_qty = np.zeros(max_pos, dtype=np.int64)
+    pos_entry_t = np.zeros(max_pos, dtype=np.int64)
+    held = np.zeros(n_codes, dtype=np.bool_)
+    n_open = 0
+
+    # 決済は1日あたり最大 max_pos 件
+    max_trades = n_days * max_pos
+    tr_code = np.empty(max_trades, dtype=np.int64)
+    tr_entry_t = np.empty(max_trades, dtype=np.int64)
+    tr_exit_t = np.empty(max_trades, dtype=np.int64)
+    tr_profit = np.empty(max_trades, dtype=np.float64)
+    tr_return = np.empty(max_trades, dtype=np.float64)
+    n_trades = 0
+
+    equity = np.empty(n_days, dtype=np.float64)
+    cash = float(cash0)
+
+    # その日にエントリーシグナルが1件でもあるか
+    any_sig = np.zeros(n_days, dtype=np.bool_)
+    for t in range(n_days):
+        for c in range(n_codes):
+            if entry_sig[t, c]:
+                any_sig[t] = True
+                break
+
+    for t in range(n_days):
+        # ポジションもシグナルも無い日は資金を記録するだけ
+        if n_open == 0 and not any_sig[t]:
+            equity[t] = cash
+            continue
+
+        # --- 0. Market Environment Check ---
+        allow_entry = sentiment[t] >= bullish_threshold
+
+        # --- 1. Exit Processing ---
+        for s in range(max_pos):
+            c = pos_code[s]
+            if c < 0 or not present[t, c]:
+                continue
+
+            if high[t, c] > pos_high_px[s]:
+                pos_high_px[s] = high[t, c]
+
+            stop_price = pos_entry_px[s] * (1 - stop_pct)
+            trail_price = pos_high_px[s] * (1 - trail_pct)
+            exit_trigger_price = max(stop_price, trail_price)
+
+            if low[t, c] <= exit_trigger_price:
+                revenue = exit_trigger_price * pos_qty[s]
+                cash += revenue
+                tr_code[n_trades] = c
+                tr_entry_t[n_trades] = pos_entry_t[s]
+                tr_exit_t[n_trades] = t
+                tr_profit[n_trades] = revenue - pos_entry_px[s] * pos_qty[s]
+                tr_return[n_trades] = (exit_trigger_price - pos_entry_px[s]) / pos_entry_px[s]
+                n_trades += 1
+
+                pos_code[s] = -1
+                held[c] = False
+                n_open -= 1
+
+        # --- 2. Entry Processing ---
+        open_slots = max_pos - n_open
+        if open_slots > 0 and allow_entry:
+            n_cand = 0
+            candidates = np.empty(n_codes, dtype=np.int64)
+            for c in range(n_codes):
+                if entry_sig[t, c] and not held[c]:
+                    candidates[n_cand] = c
+                    n_cand += 1
+
+            if n_cand > 0 and cash > 0:
+                candidates = candidates[:n_cand]
+                # 優先度上位 open_slots 件を選択（各スロットは同額配分なので順序は不要）
+                if n_cand > open_slots:
+                    scores = priority[t, candidates]
+                    candidates = candidates[np.argpartition(scores, open_slots - 1)[:open_slots]]
+                allocation = cash / open_slots
+                for c in candidates:
+                    price = close[t, c]
+                    qty = int(allocation // price)
+                    if qty > 0:
+                        cash -= qty * price
+                        # 空きスロットに格納
+                        s = 0
+                        while pos_code[s] >= 0:
+                            s += 1
+                        pos_code[s] = c
+                        pos_entry_px[s] = price
+                        pos_high_px[s] = price
+                        pos_qty[s] = qty
+                        pos_entry_t[s] = t
+                        held[c] = True
+                        n_open += 1
+
+        # --- 3. Record Equity ---
+        market_value = 0.0
+        for s in range(max_pos):
+            c = pos_code[s]
+            if c < 0:
+                continue
+            if present[t, c]:
+                market_value += close[t, c] * pos_qty[s]
+            else:
+                market_value += pos_high_px[s] * pos_qty[s]
+        equity[t] = cash + market_value
+
+    return (equity, tr_code[:n_trades], tr_entry_t[:n_trades], tr_exit_t[:n_trades],
+            tr_profit[:n_trades], tr_return[:n_trades])
@@ -0,0 +1,224 @@
+"""
+NisaJQuantBacktester.run_strategy 用の銘柄単位ステートマシン
+
+1銘柄分の価格・指標配列を受け取り、エントリー/エグジットを判定して
+トレード情報を並列配列で返す。numbaがあればネイティブコードで実行される。
+"""
+
+import numpy as np
+
+from src._njit import njit, prange
+
+# 決済理由コード
+REASON_STOP_LOSS = 0
+REASON_TRAILING = 1
+REASON_LABELS = np.array(['StopLoss', 'Trailing'], dtype=object)
+
+# ホットループ用のコンパイルオプション
+# NaNを含む価格を比較するため、nnan/ninf は有効にしない
+FASTMATH_FLAGS = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+KERNEL_OPTIONS = dict(cache=True, fastmath=FASTMATH_FLAGS, boundscheck=False, error_model='numpy')
+
+
+def entry_signals(close, ma_s, gc, dips):
+    """
+    押し目閾値ごとのエントリーシグナルを一括計算
+
+    GC形成中 かつ 価格 < MA短期 * 閾値。閾値の重複は1回だけ計算する。
+
+    Returns:
+        (signals, dip_ids): signals は (閾値の種類数, N) の uint8 配列、
+        dip_ids は各パラメータがどの行を使うかのインデックス
+    """
+    unique_dips, dip_ids = np.unique(dips, return_inverse=True)
+    ma_s = ma_s.astype(np.float64)
+    signals = np.empty((len(unique_dips), len(close)), dtype=np.uint8)
+    for k, dip in enumerate(unique_dips):
+        signals[k] = gc & (close < ma_s * dip)
+    return signals, dip_ids
+
+
+@njit(**KERNEL_OPTIONS)
+def _run_one(close, high, low, valid, entry_sig, sl, ts):
+    """
+    1銘柄分の戦略ロジック
+
+    Args:
+        close, high, low: 価格配列（日付昇順）
+        valid: MA短期/長期がともに計算済みか（bool配列）
+        entry_sig: エントリーシグナル（entry_signalsで事前計算）
+        sl: 損切り率
+        ts: トレーリングストップ率
+
+    Returns:
+        (entry_idx, exit_idx, entry_px, exit_px, reason_code)
+    """
+    n = close.shape[0]
+    # 1トレードにはエントリー日とエグジット日の2行が必要
+    max_trades = n // 2 + 1
+    entry_idx = np.empty(max_trades, dtype=np.int64)
+    exit_idx = np.empty(max_trades, dtype=np.int64)
+    entry_px = np.empty(max_trades, dtype=np.float64)
+    exit_px = np.empty(max_trades, dtype=np.float64)
+    reason_code = np.empty(max_trades, dtype=np.int8)
+
+    n_trades = 0
+    in_position = False
+    entry_i = 0
+    entry_price = 0.0
+    high_since_entry = 0.0
+
+    for i in range(n):
+        if not valid[i]:
+            continue
+
+        # --- Entry Logic ---
+        if not in_position:
+            # トレンドが上向き(GC) かつ 押し目(価格 < MA短期 * 閾値)
+            if entry_sig[i]:
+                in_position = True
+                entry_i = i
+                entry_price = close[i]
+                high_since_entry = entry_price
+
+        # --- Exit Logic ---
+        else:
+            # 高値更新
+            if high[i] > high_since_entry:
+                high_since_entry = high[i]
+
+            # 1. Stop Loss
+            if low[i] <= entry_price * (1 - sl):
+                exit_price = entry_price * (1 - sl)
+                reason = REASON_STOP_LOSS
+            # 2. Trailing Stop
+            elif low[i] <= high_since_entry * (1 - ts):
+                exit_price = high_since_entry * (1 - ts)
+                reason = REASON_TRAILING
+            else:
+                continue
+
+            entry_idx[n_trades] = entry_i
+            exit_idx[n_trades] = i
+            entry_px[n_trades] = entry_price
+            exit_px[n_trades] = exit_price
+            reason_code[n_trades] = reason
+            n_trades += 1
+            in_position = False
+
+    return (entry_idx[:n_trades], exit_idx[:n_trades], entry_px[:n_trades],
+            exit_px[:n_trades], reason_code[:n_trades])
+
+
+@njit(**KERNEL_OPTIONS)
+def _run_grid(close, high, low, valid, signals, dip_ids, sls, tss):
+    """
+    1銘柄分の戦略ロジックをパラメータグリッド全体でまとめて実行
+
+    Args:
+        close, high, low, valid: _run_one と同じ
+        signals: 押し目閾値ごとのエントリーシグナル (閾値の種類数, N)
+        dip_ids: 各パラメータが使う signals の行
+        sls, tss: パラメータごとの損切り率/トレーリング率
+
+    Returns:
+        (param_id, entry_idx, exit_idx, entry_px, exit_px, reason_code)
+    """
+    n_params = dip_ids.shape[0]
+    max_trades = n_params * (close.shape[0] // 2 + 1)
+    param_id = np.empty(max_trades, dtype=np.int64)
+    entry_idx = np.empty(max_trades, dtype=np.int64)
+    exit_idx = np.empty(max_trades, dtype=np.int64)
+    entry_px = np.empty(max_trades, dtype=np.float64)
+    exit_px = np.empty(max_trades, dtype=np.float64)
+    reason_code = np.empty(max_trades, dtype=np.int8)
+
+    n_trades = 0
+    for p in range(n_params):
+        e_idx, x_idx, e_px, x_px, r_code = _run_one(
+            close, high, low, valid, signals[dip_ids[p]], sls[p], tss[p]
+        )
+        m = e_idx.shape[0]
+        param_id[n_trades:n_trades + m] = p
+        entry_idx[n_trades:n_trades + m] = e_idx
+        exit_idx[n_trades:n_trades + m] = x_idx
+        entry_px[n_trades:n_trades + m] = e_px
+        exit_px[n_trades:n_trades + m] = x_px
+        reason_code[n_trades:n_trades + m] = r_code
+        n_trades += m
+
+    return (param_id[:n_trades], entry_idx[:n_trades], exit_idx[:n_trades],
+            entry_px[:n_trades], exit_px[:n_trades], reason_code[:n_trades])
+
+
+@njit(parallel=True, **KERNEL_OPTIONS)
+def _run_all(starts, ends, close, high, low, valid, signals, dip_ids, sls, tss):
+    """
+    全銘柄 × パラメータグリッドを銘柄単位で並列実行
+
+    配列は銘柄・日付順に並んだフラット配列で、銘柄sの行は starts[s]:ends[s]。
+
+    Returns:
+        (param_id, entry_idx, exit_idx, entry_px, exit_px, reason_code)
+        entry_idx / exit_idx はフラット配列上の行番号
+    """
+    n_stocks = starts.shape[0]
+    n_params = dip_ids.shape[0]
+
+    # 銘柄ごとの出力領域を確保（トレード数 <= エントリーシグナル数 かつ <= 行数/2+1）
+    offsets = np.zeros(n_stocks + 1, dtype=np.int64)
+    for s in range(n_stocks):
+        lo = starts[s]
+        hi = ends[s]
+        cap = 0
+        for p in range(n_params):
+            n_sig = 0
+            row = signals[dip_ids[p]]
+            for i in range(lo, hi):
+                # row は uint8 のため加算せず数える（純Python実行時に uint8 で桁あふれしない）
+                if row[i]:
+                    n_sig += 1
+            cap += min(n_sig, (hi - lo) // 2 + 1)
+        offsets[s + 1] = offsets[s] + cap
+
+    total = offsets[n_stocks]
+    param_id = np.empty(total, dtype=np.int64)
+    entry_idx = np.empty(total, dtype=np.int64)
+    exit_idx = np.empty(total, dtype=np.int64)
+    entry_px = np.empty(total, dtype=np.float64)
+    exit_px = np.empty(total, dtype=np.float64)
+    reason_code = np.empty(total, dtype=np.int8)
+    counts = np.zeros(n_stocks, dtype=np.int64)
+
+    for s in prange(n_stocks):
+        lo = starts[s]
+        hi = ends[s]
+        p_id, e_idx, x_idx, e_px, x_px, r_code = _run_grid(
+            close[lo:hi], high[lo:hi], low[lo:hi], valid[lo:hi],
+            signals[:, lo:hi], dip_ids, sls, tss
+        )
+        m = p_id.shape[0]
+        off = offsets[s]
+        param_id[off:off + m] = p_id
+        entry_idx[off:off + m] = e_idx + lo
+        exit_idx[off:off + m] = x_idx + lo
+        entry_px[off:off + m] = e_px
+        exit_px[off:off + m] = x_px
+        reason_code[off:off + m] = r_code
+        counts[s] = m
+
+    # 各銘柄の領域を前詰めする
+    n_trades = 0
+    for s in range(n_stocks):
+        off = offsets[s]
+        for k in range(counts[s]):
+            param_id[n_trades] = param_id[off + k]
+            entry_idx[n_trades] = entry_idx[off + k]
+            exit_idx[n_trades] = exit_idx[off + k]
+            entry_px[n_trades] = entry_px[off + k]
+            exit_px[n_trades] = exit_px[off + k]
+            reason_code[n_trades] = reason_code[off + k]
+            n_trades += 1
+
+    return (param_id[:n_trades], entry_idx[:n_trades], exit_idx[:n_trades],
+            entry_px[:n_trades], exit_px[:n_trades], reason_code[:n_trades])
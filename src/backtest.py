@@ -12,10 +12,15 @@ Target KPI:
 import sqlite3
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 from datetime import datetime, timedelta
 from pathlib import Path
 
+from src._strategy_loop import _run_all, entry_signals, REASON_LABELS
+from src.database import (
+    apply_read_pragmas, code_filter_clause, fetch_scalecat_codes, read_sql_columns,
+)
+from src.indicators import rolling_mean_by_code
+
 # --- Config ---
 DB_PATH = Path(__file__).parent.parent / "stock_data.db"
 
@@ -25,6 +30,12 @@ DB_PATH = Path(__file__).parent.parent / "stock_data.db"
 USE_SCALECAT_FILTER = True  # scalecatで代替フィルタリング
 SCALECAT_TARGETS = ['TOPIX Small 1', 'TOPIX Small 2', 'TOPIX Mid400']  # 小型・中型株
 
+# 読み込み時の列型（円建て四本値はfloat32で十分な精度がある）
+PRICE_DTYPES = {
+    'open': np.float32, 'high': np.float32, 'low': np.float32, 'close': np.float32,
+    'adj_close': np.float32, 'volume': np.float64,
+}
+
 
 class NisaJQuantBacktester:
     """NISA小型株トレンドフォロー戦略のバックテスター"""
@@ -39,6 +50,7 @@ class NisaJQuantBacktester:
         if not self.db_path.exists():
             raise FileNotFoundError(f"Database not found: {self.db_path}")
         self.conn = sqlite3.connect(self.db_path)
+        apply_read_pragmas(self.conn)
         print(f"[DB] Connected to {self.db_path}")
         
     def close(self):
@@ -52,29 +64,35 @@ class NisaJQuantBacktester:
         
         if USE_SCALECAT_FILTER:
             # scalecatでフィルタリング（market_cap代替）
-            scalecat_list = "', '".join(SCALECAT_TARGETS)
-            # FIX: AND f.scalecat IN (...) を追加
+            # 対象銘柄を先に取得し、JOINなしでpricesを絞り込む
+            codes = fetch_scalecat_codes(self.conn, SCALECAT_TARGETS)
+            code_cond, code_params = code_filter_clause(self.conn, codes, column="p.code")
             query = f"""
             SELECT p.date, p.code, p.open, p.high, p.low, p.close, 
-                   p.adjustmentclose as adj_close, p.volume, f.scalecat
+                   p.adjustmentclose as adj_close, p.volume
             FROM prices p
-            LEFT JOIN fundamentals f ON p.code = f.code
-            WHERE p.date >= '{start_date}'
-            AND f.scalecat IN ('{scalecat_list}')
+            WHERE p.date >= ?
+            AND {code_cond}
             ORDER BY p.code, p.date ASC
             """
+            params = [start_date, *code_params]
         else:
             # TODO: market_capフィルタリング（将来実装）
-            query = f"""
+            query = """
             SELECT p.date, p.code, p.open, p.high, p.low, p.close,
                    p.adjustmentclose as adj_close, p.volume
             FROM prices p
-            WHERE p.date >= '{start_date}'
+            WHERE p.date >= ?
             ORDER BY p.code, p.date ASC
             """
+            params = [start_date]
         
         try:
-            self.df = pd.read_sql(query, self.conn, parse_dates=['date'])
+            self.df = read_sql_columns(
+                self.conn, query, params, dtypes=PRICE_DTYPES, parse_dates=['date']
+            )
+            # 銘柄コードはカテゴリ型（内部はint32のコード）で保持
+            self.df['code'] = self.df['code'].astype('category')
             print(f"[INFO] Loaded {len(self.df)} records, {self.df['code'].nunique()} stocks")
             
             # データ期間を表示
@@ -91,13 +109,9 @@ class NisaJQuantBacktester:
         """テクニカル指標の計算"""
         df = df.copy()
         
-        # 移動平均線
-        df['ma_short'] = df.groupby('code')['close'].transform(
-            lambda x: x.rolling(ma_short, min_periods=ma_short).mean()
-        )
-        df['ma_long'] = df.groupby('code')['close'].transform(
-            lambda x: x.rolling(ma_long, min_periods=ma_long).mean()
-        )
+        # 移動平均線（bottleneck / groupby.rolling で銘柄ごとに一括計算）
+        df['ma_short'] = rolling_mean_by_code(df, ma_short)
+        df['ma_long'] = rolling_mean_by_code(df, ma_long)
         
         # ゴールデンクロス条件（トレンドフィルター）
         df['gc_trend'] = df['ma_short'] > df['ma_long']
@@ -114,67 +128,70 @@ class NisaJQuantBacktester:
         Entry: GC形成中 かつ 25日線乖離率が閾値以下（押し目）
         Exit: トレーリングストップ または 損切り
         """
-        trades = []
+        trades = self.run_strategy_grid(df, [params])
+        if trades.empty:
+            return trades
+        return trades.drop(columns='param_id')
+
+    def run_strategy_grid(self, df, param_grid):
+        """
+        複数パラメータの戦略ロジックを1パスでまとめて実行
+        
+        MA・GC列はパラメータに依存しないため、配列抽出は1回だけ行い、
+        カーネル内で銘柄（並列）とパラメータをループする。
         
-        dip_threshold = params.get('dip_threshold', 0.98)  # 25日線の98%以下で買い
-        stop_loss_pct = params.get('stop_loss', 0.10)      # -10%で損切り
-        trailing_stop_pct = params.get('trailing_stop', 0.15)  # 最高値から-15%で決済
+        Returns:
+            DataFrame: param_id列（param_gridのインデックス）付きのトレード一覧
+        """
+        dips = np.array([p.get('dip_threshold', 0.98) for p in param_grid])  # 25日線の98%以下で買い
+        sls = np.array([p.get('stop_loss', 0.10) for p in param_grid])       # -10%で損切り
+        tss = np.array([p.get('trailing_stop', 0.15) for p in param_grid])   # 最高値から-15%で決済
 
-        for code, sub_df in df.groupby('code'):
-            sub_df = sub_df.sort_values('date')
-            position = None
-            entry_price = 0
-            entry_date = None
-            high_since_entry = 0
+        if df.empty:
+            return pd.DataFrame()
 
-            for _, row in sub_df.iterrows():
-                if pd.isna(row['ma_short']) or pd.isna(row['ma_long']):
-                    continue
+        # load_data 以外で作られたフレーム（code が文字列列）も受け付ける（呼び出し元は変更しない）
+        code = df['code']
+        if not isinstance(code.dtype, pd.CategoricalDtype):
+            code = code.astype('category')
 
-                # --- Entry Logic ---
-                if position is None:
-                    # トレンドが上向き(GC) かつ 押し目(価格 < MA短期 * 閾値)
-                    if row['gc_trend'] and (row['close'] < row['ma_short'] * dip_threshold):
-                        position = 'LONG'
-                        entry_price = row['close']
-                        entry_date = row['date']
-                        high_since_entry = entry_price
-                
-                # --- Exit Logic ---
-                elif position == 'LONG':
-                    # 高値更新
-                    if row['high'] > high_since_entry:
-                        high_since_entry = row['high']
-                    
-                    # 1. Stop Loss
-                    if row['low'] <= entry_price * (1 - stop_loss_pct):
-                        exit_price = entry_price * (1 - stop_loss_pct)
-                        trades.append({
-                            'code': code,
-                            'entry_date': entry_date,
-                            'exit_date': row['date'],
-                            'entry_price': entry_price,
-                            'exit_price': exit_price,
-                            'return': (exit_price - entry_price) / entry_price,
-                            'reason': 'StopLoss'
-                        })
-                        position = None
-                    
-                    # 2. Trailing Stop
-                    elif row['low'] <= high_since_entry * (1 - trailing_stop_pct):
-                        exit_price = high_since_entry * (1 - trailing_stop_pct)
-                        trades.append({
-                            'code': code,
-                            'entry_date': entry_date,
-                            'exit_date': row['date'],
-                            'entry_price': entry_price,
-                            'exit_price': exit_price,
-                            'return': (exit_price - entry_price) / entry_price,
-                            'reason': 'Trailing'
-                        })
-                        position = None
+        # 必要な列だけを (code, date) 順の配列として取り出す（DataFrame全体のソート/コピーはしない）
+        codes = code.cat.codes.to_numpy(np.int32)
+        dates = df['date'].to_numpy()
+        order = np.lexsort((dates, codes))
+        codes, dates = codes[order], dates[order]
+
+        def column(name, dtype=np.float32):
+            return df[name].to_numpy(dtype=dtype)[order]
+
+        close = column('close')
+        ma_short = column('ma_short')
+        valid = ~np.isnan(ma_short) & ~np.isnan(column('ma_long'))
+        # エントリー条件は損切り/トレーリング率に依存しないので、閾値ごとに先に計算しておく
+        signals, dip_ids = entry_signals(close, ma_short, column('gc_trend', np.bool_), dips)
+
+        # 銘柄ごとの行範囲（codeでソート済みなので連続している）
+        boundaries = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(codes)]))
 
-        return pd.DataFrame(trades)
+        param_id, entry_idx, exit_idx, entry_px, exit_px, reason_code = _run_all(
+            starts, ends, close, column('high'), column('low'),
+            valid, signals, dip_ids, sls, tss
+        )
+        if len(entry_idx) == 0:
+            return pd.DataFrame()
+
+        return pd.DataFrame({
+            'param_id': param_id,
+            'code': code.cat.categories[codes[entry_idx]],
+            'entry_date': dates[entry_idx],
+            'exit_date': dates[exit_idx],
+            'entry_price': entry_px,
+            'exit_price': exit_px,
+            'return': (exit_px - entry_px) / entry_px,
+            'reason': REASON_LABELS[reason_code]
+        })
 
     def walk_forward_analysis(self, n_splits=5):
         """
@@ -192,8 +209,12 @@ class NisaJQuantBacktester:
         # データにインジケーターを計算
         df = self.calculate_indicators(self.df)
         
+        # 日付順に並べ替え、期間の切り出しはsearchsortedで求めた範囲のスライスで行う
+        df = df.sort_values(['date', 'code']).reset_index(drop=True)
+        date_arr = df['date'].to_numpy()
+        
         # 全期間のユニークな日付を取得して分割
-        dates = sorted(df['date'].unique())
+        dates = np.unique(date_arr)
         
         if len(dates) < n_splits + 1:
             print(f"[WARN] Not enough data for {n_splits} splits. Using available data.")
@@ -230,21 +251,19 @@ class NisaJQuantBacktester:
             print(f"          Test[{pd.Timestamp(test_start).date()} ~ {pd.Timestamp(test_end).date()}]")
 
             # --- Optimization Phase (In-Sample) ---
-            train_data = df[(df['date'] >= train_start) & (df['date'] < train_end)]
+            lo, hi = np.searchsorted(date_arr, [train_start, train_end])
+            train_data = df.iloc[lo:hi]
             
-            best_param = None
-            best_score = -999
+            # 全パラメータを1回のスイープで評価（トレードなしはスコア0）
+            trades = self.run_strategy_grid(train_data, param_grid)
+            scores = np.zeros(len(param_grid))
+            if not trades.empty:
+                mean_returns = trades.groupby('param_id')['return'].mean()
+                scores[mean_returns.index.to_numpy()] = mean_returns.to_numpy()
             
-            for param in param_grid:
-                trades = self.run_strategy(train_data, param)
-                if not trades.empty:
-                    score = trades['return'].mean()
-                else:
-                    score = 0
-                
-                if score > best_score:
-                    best_score = score
-                    best_param = param
+            best_idx = int(np.argmax(scores))
+            best_param = param_grid[best_idx]
+            best_score = scores[best_idx]
             
             if best_param:
                 print(f"  Best Param: dip={best_param['dip_threshold']}, "
@@ -252,7 +271,8 @@ class NisaJQuantBacktester:
                       f"(Score: {best_score:.2%})")
 
             # --- Validation Phase (Out-of-Sample) ---
-            test_data = df[(df['date'] >= test_start) & (df['date'] < test_end)]
+            lo, hi = np.searchsorted(date_arr, [test_start, test_end])
+            test_data = df.iloc[lo:hi]
             
             if best_param and not test_data.empty:
                 oos_trades = self.run_strategy(test_data, best_param)
@@ -286,9 +306,12 @@ class NisaJQuantBacktester:
         
         # Drawdown Calculation
         trades = trades.sort_values('exit_date')
-        trades['cum_return'] = trades['return'].cumsum()
-        trades['rolling_max'] = trades['cum_return'].cummax()
-        trades['drawdown'] = trades['cum_return'] - trades['rolling_max']
+        # 計算はNumPy配列で行い、返り値のtradesには従来どおり列として残す
+        cum_return = np.cumsum(trades['return'].to_numpy())
+        rolling_max = np.maximum.accumulate(cum_return)
+        trades['cum_return'] = cum_return
+        trades['rolling_max'] = rolling_max
+        trades['drawdown'] = cum_return - rolling_max
         max_dd = trades['drawdown'].min()
 
         print(f"Total Trades: {total_trades}")
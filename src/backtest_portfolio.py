@@ -3,11 +3,22 @@ Phase 2.6: Portfolio Backtest Engine (with Market Filter)
 市場環境フィルターを追加し、ドローダウンを抑制する。
 """
 import sqlite3
+import time
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 from pathlib import Path
 
+try:
+    import duckdb  # 列指向スキャン（任意）
+except ImportError:
+    duckdb = None
+
+from src._portfolio_loop import _simulate
+from src.database import (
+    apply_read_pragmas, code_filter_clause, fetch_scalecat_codes, read_sql_columns,
+)
+from src.indicators import rolling_mean_by_code
+
 # --- Config (The Safety First - Coward's Strategy) ---
 DB_PATH = Path(__file__).parent.parent / "stock_data.db"
 INITIAL_CAPITAL = 3000000  # 300万円
@@ -25,38 +36,70 @@ MARKET_BULLISH_THRESHOLD = 0.40
 USE_SCALECAT_FILTER = True
 SCALECAT_TARGETS = ['TOPIX Small 1', 'TOPIX Small 2', 'TOPIX Mid400']
 
+# 読み込み時の列型（円建て四本値はfloat32で十分な精度がある）
+PRICE_DTYPES = {'open': np.float32, 'high': np.float32, 'low': np.float32, 'close': np.float32}
+
 class PortfolioBacktester:
     def __init__(self, db_path=DB_PATH):
-        self.conn = sqlite3.connect(db_path)
+        # DuckDBが使えればSQLiteファイルをATTACHして列指向でスキャンする
+        self.use_duckdb = False
+        if duckdb is not None:
+            self.conn = duckdb.connect()
+            try:
+                self.conn.execute("INSTALL sqlite; LOAD sqlite;")
+                safe_path = str(db_path).replace("'", "''")
+                self.conn.execute(f"ATTACH '{safe_path}' AS s (TYPE sqlite, READ_ONLY)")
+                self.conn.execute("USE s")
+                self.use_duckdb = True
+                print("[DB] Using DuckDB (sqlite scanner)")
+            except Exception as e:
+                self.conn.close()
+                print(f"[WARN] DuckDB unavailable, falling back to sqlite3: {e}")
+
+        if not self.use_duckdb:
+            self.conn = sqlite3.connect(db_path)
+            apply_read_pragmas(self.conn)
         
     def load_data(self, start_date="2015-01-01"):
         print("[INFO] Loading data...")
         if USE_SCALECAT_FILTER:
-            scalecat_list = "', '".join(SCALECAT_TARGETS)
+            # 対象銘柄を先に取得し、JOINなしでpricesを絞り込む
+            codes = fetch_scalecat_codes(self.conn, SCALECAT_TARGETS)
+            code_cond, code_params = code_filter_clause(self.conn, codes, column="p.code")
             query = f"""
-            SELECT p.date, p.code, p.open, p.high, p.low, p.close, f.scalecat
+            SELECT p.date, p.code, p.open, p.high, p.low, p.close
             FROM prices p
-            LEFT JOIN fundamentals f ON p.code = f.code
-            WHERE p.date >= '{start_date}'
-            AND f.scalecat IN ('{scalecat_list}')
+            WHERE p.date >= ?
+            AND {code_cond}
             ORDER BY p.date ASC
             """
+            params = [start_date, *code_params]
         else:
-            query = f"SELECT date, code, open, high, low, close FROM prices WHERE date >= '{start_date}' ORDER BY date ASC"
+            query = "SELECT date, code, open, high, low, close FROM prices WHERE date >= ? ORDER BY date ASC"
+            params = [start_date]
 
-        self.df = pd.read_sql(query, self.conn, parse_dates=['date'])
+        if self.use_duckdb:
+            self.df = self.conn.execute(query, params).fetch_df()
+            self.df['date'] = pd.to_datetime(self.df['date'])
+            self.df = self.df.astype(PRICE_DTYPES)
+        else:
+            self.df = read_sql_columns(self.conn, query, params, dtypes=PRICE_DTYPES, parse_dates=['date'])
+        # 銘柄コードはカテゴリ型（内部はint32のコード）で保持
+        self.df['code'] = self.df['code'].astype('category')
         self.df = self.df.sort_values(['date', 'code'])
         print(f"[INFO] Loaded {len(self.df)} records.")
 
     def calculate_signals(self):
         """全銘柄のテクニカル指標とシグナルを一括計算"""
         print("[INFO] Calculating indicators...")
-        # 処理速度向上のため、groupbyで計算
-        self.df['ma_short'] = self.df.groupby('code')['close'].transform(lambda x: x.rolling(25).mean())
-        self.df['ma_long'] = self.df.groupby('code')['close'].transform(lambda x: x.rolling(75).mean())
+        # 処理速度向上のため、bottleneck / groupby.rolling で銘柄ごとに一括計算
+        self.df['ma_short'] = rolling_mean_by_code(self.df, 25)
+        self.df['ma_long'] = rolling_mean_by_code(self.df, 75)
         
         # トレンド判定用（市場環境フィルターに使用）
         self.df['is_bullish'] = self.df['close'] > self.df['ma_long']
+        # 日ごとの市場センチメント（上昇トレンド銘柄の比率）を一括集計
+        self.market_sentiment = self.df.groupby('date', sort=True)['is_bullish'].mean()
 
         # エントリー条件: GC発生中 AND 押し目
         self.df['gc_trend'] = self.df['ma_short'] > self.df['ma_long']
@@ -65,98 +108,59 @@ class PortfolioBacktester:
         # 優先順位用スコア（乖離率：より深く押しているものを優先）
         self.df['priority_score'] = self.df['close'] / self.df['ma_short']
 
+        self.build_panel()
+
+    def build_panel(self):
+        """シミュレーション用に (日付, 銘柄) の2次元NumPy配列へ展開する"""
+        self.dates = pd.DatetimeIndex(self.df['date'].unique()).sort_values()
+        self.sentiment_arr = self.market_sentiment.reindex(self.dates, fill_value=0.0).to_numpy(np.float64)
+        if not isinstance(self.df['code'].dtype, pd.CategoricalDtype):
+            self.df['code'] = self.df['code'].astype('category')
+        # 列番号 = カテゴリコード（self.codes[i] で銘柄コードに戻す）
+        self.codes = self.df['code'].cat.categories
+        t_idx = self.dates.get_indexer(self.df['date'])
+        c_idx = self.df['code'].cat.codes.to_numpy()
+        shape = (len(self.dates), len(self.codes))
+
+        def to_panel(col, fill):
+            values = self.df[col].to_numpy()
+            arr = np.full(shape, fill, dtype=values.dtype)
+            arr[t_idx, c_idx] = values
+            return arr
+
+        # present: その日に該当銘柄の行が存在するか
+        self.present = np.zeros(shape, dtype=bool)
+        self.present[t_idx, c_idx] = True
+        self.close_arr = to_panel('close', np.nan)
+        self.high_arr = to_panel('high', np.nan)
+        self.low_arr = to_panel('low', np.nan)
+        self.entry_arr = to_panel('entry_signal', False)
+        self.priority_arr = to_panel('priority_score', np.nan)
+
     def run_simulation(self):
         print(f"[INFO] Running Portfolio Simulation (Market Filter > {MARKET_BULLISH_THRESHOLD:.0%})...")
         
-        cash = INITIAL_CAPITAL
-        positions = {}
-        equity_curve = []
-        trade_log = []
-
-        dates = self.df['date'].unique()
-        
-        for current_date in tqdm(dates, desc="Simulating Days"):
-            daily_data = self.df[self.df['date'] == current_date]
-            if daily_data.empty: continue
-            
-            # --- 0. Market Environment Check (NEW) ---
-            # その日の全銘柄のうち、MA75を超えている銘柄の割合を計算
-            # ※ daily_dataはフィルタリング済みの小型株ユニバースなので、これを市場指数として扱う
-            n_stocks = len(daily_data)
-            n_bullish = daily_data['is_bullish'].sum()
-            market_sentiment = n_bullish / n_stocks if n_stocks > 0 else 0
-            
-            # 市場が「弱気（全面安）」なら、新規買いを禁止する
-            allow_entry = market_sentiment >= MARKET_BULLISH_THRESHOLD
-            
-            # --- 1. Exit Processing ---
-            codes_to_sell = []
-            for code, pos in positions.items():
-                row = daily_data[daily_data['code'] == code]
-                if row.empty: continue
-                
-                price_high = row.iloc[0]['high']
-                price_low = row.iloc[0]['low']
-                
-                if price_high > pos['highest_price']:
-                    positions[code]['highest_price'] = price_high
-                
-                stop_price = pos['entry_price'] * (1 - STOP_LOSS_PCT)
-                trail_price = positions[code]['highest_price'] * (1 - TRAILING_STOP_PCT)
-                exit_trigger_price = max(stop_price, trail_price)
-                
-                if price_low <= exit_trigger_price:
-                    sell_price = exit_trigger_price
-                    revenue = sell_price * pos['qty']
-                    cash += revenue
-                    profit = revenue - (pos['entry_price'] * pos['qty'])
-                    profit_pct = (sell_price - pos['entry_price']) / pos['entry_price']
-                    trade_log.append({
-                        'code': code, 'profit': profit, 'return': profit_pct, 
-                        'reason': 'Stop/Trail', 'exit_date': current_date
-                    })
-                    codes_to_sell.append(code)
-            
-            for code in codes_to_sell:
-                del positions[code]
-
-            # --- 2. Entry Processing ---
-            # 市場環境が良いときだけエントリー
-            open_slots = MAX_POSITIONS - len(positions)
-            if open_slots > 0 and allow_entry:
-                candidates = daily_data[daily_data['entry_signal']].copy()
-                candidates = candidates[~candidates['code'].isin(positions.keys())]
-                
-                if not candidates.empty:
-                    candidates = candidates.sort_values('priority_score')
-                    targets = candidates.head(open_slots)
-                    
-                    if cash > 0:
-                        allocation = cash / open_slots
-                        for _, row in targets.iterrows():
-                            price = row['close']
-                            qty = int(allocation // price)
-                            if qty > 0:
-                                cost = qty * price
-                                cash -= cost
-                                positions[row['code']] = {
-                                    'entry_price': price, 'highest_price': price, 
-                                    'qty': qty, 'entry_date': current_date
-                                }
-
-            # --- 3. Record Equity ---
-            market_value = 0
-            for code, pos in positions.items():
-                row = daily_data[daily_data['code'] == code]
-                if not row.empty:
-                    market_value += row.iloc[0]['close'] * pos['qty']
-                else:
-                    market_value += pos['highest_price'] * pos['qty']
-
-            total_equity = cash + market_value
-            equity_curve.append({'date': current_date, 'equity': total_equity})
-
-        return pd.DataFrame(equity_curve), pd.DataFrame(trade_log)
+        # 日次ループはJIT内で完結するため、進捗バーは出さず最後に1行だけ要約を出す
+        started = time.perf_counter()
+        equity, tr_code, tr_entry_t, tr_exit_t, tr_profit, tr_return = _simulate(
+            self.close_arr, self.high_arr, self.low_arr, self.present,
+            self.sentiment_arr, self.entry_arr, self.priority_arr,
+            STOP_LOSS_PCT, TRAILING_STOP_PCT, MARKET_BULLISH_THRESHOLD,
+            MAX_POSITIONS, INITIAL_CAPITAL
+        )
+        print(f"[INFO] Simulated {len(self.dates)} days, {len(tr_code)} trades "
+              f"in {time.perf_counter() - started:.2f}s")
+
+        equity_df = pd.DataFrame({'date': self.dates, 'equity': equity})
+        # バッファを一括でDataFrame化（行ごとのdict生成は行わない）
+        trades_df = pd.DataFrame({
+            'code': self.codes[tr_code], 'profit': tr_profit, 'return': tr_return,
+            'reason': 'Stop/Trail', 'entry_date': self.dates[tr_entry_t],
+            'exit_date': self.dates[tr_exit_t]
+        })
+        if trades_df.empty:
+            trades_df = pd.DataFrame()
+        return equity_df, trades_df
 
     def print_results(self, equity_df, trades_df):
         print("\n=== PORTFOLIO SIMULATION RESULTS (Final) ===")
@@ -165,8 +169,11 @@ class PortfolioBacktester:
         initial = equity_df.iloc[0]['equity']
         final = equity_df.iloc[-1]['equity']
         
-        equity_df['max_equity'] = equity_df['equity'].cummax()
-        equity_df['drawdown'] = (equity_df['equity'] - equity_df['max_equity']) / equity_df['max_equity']
+        # 計算はNumPy配列で行い、equity_dfには従来どおり列として残す
+        equity = equity_df['equity'].to_numpy()
+        peak = np.maximum.accumulate(equity)
+        equity_df['max_equity'] = peak
+        equity_df['drawdown'] = (equity - peak) / peak
         max_dd = equity_df['drawdown'].min()
         
         days = (equity_df.iloc[-1]['date'] - equity_df.iloc[0]['date']).days
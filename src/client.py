@@ -11,18 +11,32 @@ V2 エンドポイント:
 """
 
 import os
-import requests
+import threading
 import time
 
+import requests
+from requests.adapters import HTTPAdapter
+
 
 class JQuantsClient:
     """J-Quants APIクライアント (V2対応)"""
     
     # V2 API Base URL
     BASE_URL = "https://api.jquants.com/v2"
+    
+    # リクエスト間の最小間隔（従来の1リクエスト/秒。並列取得時もAPI全体でこの間隔を下回らない）
+    DEFAULT_MIN_INTERVAL = 1.0
 
-    def __init__(self):
-        """環境変数からAPIキーを取得してクライアントを初期化"""
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, pool_maxsize=16):
+        """
+        環境変数からAPIキーを取得してクライアントを初期化
+        
+        Args:
+            min_interval: リクエスト間の最小間隔（秒、スレッド間で共有）。
+                レートリミットヘッダーはこれより長く待つ場合にのみ使う
+                （ヘッダーが返らない場合もこの間隔は守られる）
+            pool_maxsize: keep-aliveで保持する接続数の上限
+        """
         # V2ではAPIキーを使用（環境変数名は互換性のため両方サポート）
         self.api_key = os.getenv("JQUANTS_API_KEY") or os.getenv("JQUANTS_REFRESH_TOKEN")
         
@@ -35,6 +49,57 @@ class JQuantsClient:
         self.headers = {
             "x-api-key": self.api_key
         }
+        
+        # Sessionで接続（TLSハンドシェイク）を使い回す
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize))
+        
+        # 並列取得時もAPI全体でリクエスト間隔を守る
+        self.min_interval = min_interval
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._last_headers = {}
+
+    def _wait_for_slot(self):
+        """前回のリクエストから min_interval 秒空くまで待機"""
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def _defer_requests(self, seconds):
+        """全スレッドの次回リクエストを seconds 秒後以降に遅らせる"""
+        with self._rate_lock:
+            self._next_request_at = max(self._next_request_at, time.monotonic() + seconds)
+
+    @staticmethod
+    def _header_seconds(value, default):
+        """待機秒数を表すヘッダー値を秒に変換（UNIX時刻の場合は現在時刻との差）"""
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            return default
+        if seconds > 1e9:
+            seconds -= time.time()
+        return max(seconds, 0.0)
+
+    def _apply_rate_headers(self, headers):
+        """残りリクエスト数が尽きそうな時だけリセットまで待機させる"""
+        self._last_headers = headers
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+        except ValueError:
+            return
+        if remaining <= 1:
+            wait_time = self._header_seconds(headers.get("X-RateLimit-Reset"), 1.0)
+            print(f"[API] Rate limit almost reached, pausing {wait_time:.1f} seconds...")
+            self._defer_requests(wait_time)
 
     def get(self, endpoint, params=None):
         """APIエンドポイントにGETリクエストを送る"""
@@ -44,19 +109,22 @@ class JQuantsClient:
         retry_count = 0
         
         while retry_count < max_retries:
-            response = requests.get(url, headers=self.headers, params=params)
+            self._wait_for_slot()
+            response = self.session.get(url, params=params)
             
             if response.status_code == 200:
+                self._apply_rate_headers(response.headers)
                 return response.json()
             elif response.status_code == 401:
                 raise Exception(f"Authentication failed (401): Check your API key")
             elif response.status_code == 403:
                 raise Exception(f"Forbidden (403): {response.text}")
             elif response.status_code == 429:
-                # レートリミット - 長めに待機
-                wait_time = 5 * (retry_count + 1)  # 5, 10, 15, 20...秒
-                print(f"[API] Rate limit, waiting {wait_time} seconds...")
-                time.sleep(wait_time)
+                # レートリミット - Retry-Afterがあれば従い、なければ指数バックオフ
+                backoff = min(5 * 2 ** retry_count, 60)  # 5, 10, 20, 40, 60...秒
+                wait_time = self._header_seconds(response.headers.get("Retry-After"), backoff)
+                print(f"[API] Rate limit, waiting {wait_time:.1f} seconds...")
+                self._defer_requests(wait_time)
                 retry_count += 1
                 continue
             else:
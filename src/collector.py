@@ -6,11 +6,38 @@ JQuantsClientとStockDatabaseを組み合わせて、
 中断再開機能とtqdmによる進捗表示を含む。
 """
 
+import sys
 import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import time
+from itertools import islice
 from tqdm import tqdm
 
+# 株価保存をまとめてコミットする間隔（日数）
+COMMIT_INTERVAL_DAYS = 30
+
+# 日足を並列取得するスレッド数（リクエスト間隔はJQuantsClientが制御）
+FETCH_WORKERS = 4
+
+# V2カラム名 -> DBカラム名
+COLUMN_MAPPING = {
+    "Date": "date",
+    "Code": "code",
+    "O": "open",
+    "H": "high",
+    "L": "low",
+    "C": "close",
+    "Vo": "volume",
+    "Va": "turnover",
+    "AdjFactor": "adjustmentfactor",
+    "AdjO": "adjustmentopen",
+    "AdjH": "adjustmenthigh",
+    "AdjL": "adjustmentlow",
+    "AdjC": "adjustmentclose",
+    "AdjVo": "adjustmentvolume",
+}
+
 
 class DataCollector:
     """データ収集クラス (V2 API対応)"""
@@ -74,68 +101,81 @@ class DataCollector:
         print(f"[INFO] Total days: {days_num}")
         print("=" * 50)
 
-        # 3. 1日ずつループして取得
-        total_records = 0
-        for i in tqdm(range(days_num), desc="Fetching prices"):
-            current_dt = start_dt + timedelta(days=i)
-            
+        # 3. 営業日ごとに並列取得し、日付順に保存
+        dates = [
+            (start_dt + timedelta(days=i)).strftime("%Y-%m-%d")
+            for i in range(days_num)
             # 土日はスキップ (5=土, 6=日)
-            if current_dt.weekday() >= 5:
-                continue
-
-            date_str = current_dt.strftime("%Y-%m-%d")
-            
-            try:
-                # V2 API: 日足データを取得
-                res = self.client.get_daily_quotes(date=date_str)
-                quotes = res.get("data", [])
-                
-                if not quotes:
-                    # 祝日などでデータがない場合
-                    continue
-
-                # DataFrame化
-                df = pd.DataFrame(quotes)
-                
-                # V2カラム名をDB用にマッピング
-                column_mapping = {
-                    "Date": "date",
-                    "Code": "code",
-                    "O": "open",
-                    "H": "high",
-                    "L": "low",
-                    "C": "close",
-                    "Vo": "volume",
-                    "Va": "turnover",
-                    "AdjFactor": "adjustmentfactor",
-                    "AdjO": "adjustmentopen",
-                    "AdjH": "adjustmenthigh",
-                    "AdjL": "adjustmentlow",
-                    "AdjC": "adjustmentclose",
-                    "AdjVo": "adjustmentvolume",
-                }
-                df = df.rename(columns=column_mapping)
-                
-                # 必要なカラムのみ抽出
-                available_cols = [c for c in column_mapping.values() if c in df.columns]
-                df = df[available_cols]
-                
-                # データベースに保存
-                count = self.db.save_daily_quotes(df)
-                total_records += count
+            if (start_dt + timedelta(days=i)).weekday() < 5
+        ]
+        total_records = 0
+        # ログファイルへのリダイレクト時（run_daily.bat）はプログレスバーを出さない
+        progress = tqdm(total=len(dates), desc="Fetching prices",
+                        mininterval=1.0, disable=not sys.stderr.isatty())
+        executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+        # 先読みは FETCH_WORKERS * 2 日分まで（メモリを抑えつつ待ち時間を重ねる）
+        day_iter = iter(dates)
+        pending = deque(
+            (date_str, executor.submit(self._fetch_day, date_str))
+            for date_str in islice(day_iter, FETCH_WORKERS * 2)
+        )
+        try:
+            n_done = 0
+            while pending:
+                # 中断再開のため、完了順ではなく日付順に保存する
+                date_str, future = pending.popleft()
+                next_date = next(day_iter, None)
+                if next_date is not None:
+                    pending.append((next_date, executor.submit(self._fetch_day, next_date)))
                 
-                # 進捗を更新
-                self.db.update_sync_progress("prices", date_str)
+                try:
+                    df = future.result()
+                except Exception as e:
+                    print(f"\n[ERROR] Failed to fetch {date_str}: {e}")
+                    print("[INFO] Progress saved. Run again to resume.")
+                    raise
                 
-                # レートリミット対策（1秒待機）
-                time.sleep(1.0)
+                # 祝日などでデータがない日は進捗を進めない
+                if df is not None:
+                    # データベースに保存
+                    total_records += self.db.save_daily_quotes(df)
+                    # 進捗を更新
+                    self.db.update_sync_progress("prices", date_str)
                 
-            except Exception as e:
-                print(f"\n[ERROR] Failed to fetch {date_str}: {e}")
-                print("[INFO] Progress saved. Run again to resume.")
-                raise
+                n_done += 1
+                progress.update(1)
+                # 1日ごとではなく一定日数ごとにまとめてコミット
+                if n_done % COMMIT_INTERVAL_DAYS == 0:
+                    self.db.commit()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            progress.close()
+            # 中断時も保存済みの日までをコミット（株価とsync_progressは同一トランザクション）
+            self.db.commit()
+
+        # 大量INSERT後にプランナー用の統計情報を更新
+        if total_records:
+            self.db.analyze()
 
         print("\n" + "=" * 50)
         print(f"[DONE] Fetched {total_records} price records")
         print(f"[DONE] Total records in DB: {self.db.get_price_count()}")
-        print("=" * 50)
\ No newline at end of file
+        print("=" * 50)
+
+    def _fetch_day(self, date_str):
+        """
+        1日分の日足を取得してDB保存用のDataFrameに変換（ワーカースレッドで実行）
+        
+        Returns:
+            DataFrame（データがない日はNone）
+        """
+        # V2 API: 日足データを取得（間隔制御はクライアント側で行う）
+        res = self.client.get_daily_quotes(date=date_str)
+        quotes = res.get("data", [])
+        if not quotes:
+            return None
+        
+        # V2カラム名をDB用にマッピングし、必要なカラムのみ抽出
+        df = pd.DataFrame(quotes).rename(columns=COLUMN_MAPPING)
+        available_cols = [c for c in COLUMN_MAPPING.values() if c in df.columns]
+        return df[available_cols]
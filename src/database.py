@@ -4,10 +4,179 @@ SQLiteデータベース操作クラス
 株価データと財務情報をSQLiteデータベースに保存する。
 """
 
+import json
 import sqlite3
 import os
+import time
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
+# 書き込み（データ収集）向けのPRAGMA
+WRITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",     # 約64MB
+    "PRAGMA temp_store=MEMORY",
+)
+
+# 大量読み込み（バックテスト等）向けのPRAGMA
+# 接続ごとの設定のみ（journal_mode等DBファイルに残る設定は書き込み側で行う）
+READ_PRAGMAS = (
+    "PRAGMA mmap_size=268435456",   # 256MB
+    "PRAGMA cache_size=-200000",    # 約200MB
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def apply_read_pragmas(conn):
+    """大量読み込み向けのPRAGMAを接続に適用する"""
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+
+
+def open_readonly(db_path):
+    """
+    参照専用の接続を開く（評価・エクスポートの一括読み込み用）
+    
+    mode=ro + query_only で誤った書き込みを防ぎつつ、mmap/キャッシュを広げる。
+    一時テーブルも作れないため、必要な処理では通常の接続を使うこと。
+    """
+    conn = sqlite3.connect(Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+    for pragma in READ_PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+
+def ensure_scan_indexes(conn):
+    """
+    銘柄×日付スキャン用のインデックスを作成
+    
+    書き込み側（StockDatabase._init_db / save_fundamentals / update_yfinance）でのみ呼ぶ。
+    fundamentalsはsave_fundamentalsで丸ごと置き換えられるため、置き換えのたびに作り直す。
+    読み込み専用の処理からは呼ばない（レポート実行でDBのスキーマを変えない）。
+    コミットは呼び出し側で行う。
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_prices_code_date ON prices(code, date)")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(fundamentals)")]
+    if 'scalecat' in columns:
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_fundamentals_code_scalecat ON fundamentals(code, scalecat)"
+        )
+        # fetch_scalecat_codes の scalecat IN (...) を索引の範囲検索にする
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_fundamentals_scalecat_code ON fundamentals(scalecat, code)"
+        )
+
+
+# prices テーブルの列（スキーマ定義順）
+PRICE_COLUMNS = (
+    "date", "code", "open", "high", "low", "close", "volume", "turnover",
+    "adjustmentfactor", "adjustmentopen", "adjustmenthigh", "adjustmentlow",
+    "adjustmentclose", "adjustmentvolume",
+)
+_INSERT_PRICES_SQL = (
+    f"INSERT OR IGNORE INTO prices ({', '.join(PRICE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(PRICE_COLUMNS))})"
+)
+
+# これを超える銘柄数はIN句に展開せず一時テーブル経由で絞り込む
+MAX_INLINE_CODES = 500
+
+
+def fetch_scalecat_codes(conn, targets):
+    """
+    指定した規模区分（scalecat）に属する銘柄コードを取得
+    
+    Args:
+        conn: sqlite3 / DuckDB 接続
+        targets: scalecat のリスト
+    
+    Returns:
+        list: 銘柄コードのリスト（重複なし）
+    """
+    placeholders = ", ".join("?" * len(targets))
+    rows = conn.execute(
+        f"SELECT DISTINCT code FROM fundamentals WHERE scalecat IN ({placeholders})",
+        list(targets)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+def code_filter_clause(conn, codes, column="code"):
+    """
+    銘柄コードの許可リストをWHERE句の条件に変換
+    
+    prices と fundamentals のJOINを読み込みのたびに走らせないよう、
+    先に取得したコード一覧で prices を直接絞り込む。
+    MAX_INLINE_CODES 件以下はバインドパラメータのIN句、
+    それを超える場合は一時テーブル small_codes（メモリ上）を使う。
+    
+    Returns:
+        tuple: (SQL条件文字列, バインドパラメータのリスト)
+    """
+    if len(codes) <= MAX_INLINE_CODES:
+        if not codes:
+            return "0 = 1", []
+        placeholders = ", ".join("?" * len(codes))
+        return f"{column} IN ({placeholders})", list(codes)
+    
+    conn.execute("DROP TABLE IF EXISTS small_codes")
+    conn.execute("CREATE TEMP TABLE small_codes (code TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO small_codes VALUES (?)", [(code,) for code in codes])
+    return f"{column} IN (SELECT code FROM small_codes)", []
+
+
+def read_sql_columns(conn, query, params=(), dtypes=None, parse_dates=None, chunk_size=100_000):
+    """
+    クエリ結果をカーソルから分割取得し、列ごとのNumPy配列としてDataFrameを構築
+    
+    pd.read_sqlは全行のタプルリストを保持したままDataFrame化するため、
+    ピークメモリが倍になる。ここではchunk_size行ずつ型付き配列に変換して
+    タプルを順次解放する。
+    
+    Args:
+        conn: sqlite3接続
+        query: SQL文
+        params: バインドパラメータ
+        dtypes: {列名: dtype} 指定がない列はobjectのまま
+        parse_dates: datetimeに変換する列名のリスト
+        chunk_size: 一度に取得する行数
+    
+    Returns:
+        DataFrame
+    """
+    dtypes = dtypes or {}
+    parse_dates = parse_dates or []
+    
+    cursor = conn.execute(query, params)
+    columns = [desc[0] for desc in cursor.description]
+    
+    chunks = {name: [] for name in columns}
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for name, values in zip(columns, zip(*rows)):
+            if name in parse_dates:
+                arr = pd.to_datetime(np.array(values, dtype=object)).to_numpy()
+            else:
+                arr = np.array(values, dtype=dtypes.get(name, object))
+            chunks[name].append(arr)
+        del rows
+    
+    data = {}
+    for name in columns:
+        if chunks[name]:
+            data[name] = np.concatenate(chunks[name])
+        elif name in parse_dates:
+            data[name] = np.array([], dtype='datetime64[ns]')
+        else:
+            data[name] = np.array([], dtype=dtypes.get(name, object))
+    return pd.DataFrame(data, columns=columns)
+
 
 class StockDatabase:
     """SQLiteデータベース操作クラス"""
@@ -20,8 +189,53 @@ class StockDatabase:
             db_path: SQLiteデータベースファイルのパス
         """
         self.db_path = db_path
+        self._conn = None
         self._init_db()
 
+    def _get_conn(self):
+        """
+        接続を取得（インスタンス内で1本を使い回す）
+        
+        isolation_level=None（自動コミット）で開き、書き込み時だけ
+        _begin() で明示的にトランザクションを張る。読み込みはトランザクションなし。
+        """
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            for pragma in WRITE_PRAGMAS:
+                self._conn.execute(pragma)
+        return self._conn
+
+    def _begin(self):
+        """書き込みトランザクションを開始（開始済みならそのまま継続）"""
+        conn = self._get_conn()
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def commit(self):
+        """保留中の書き込みをコミット"""
+        if self._conn is not None:
+            self._conn.commit()
+
+    def analyze(self):
+        """
+        統計情報を更新（大量INSERT後に実行）
+        
+        prices(date, code) の主キーやidx_prices_code_dateを
+        クエリプランナーが正しく選べるようにする。
+        """
+        conn = self._get_conn()
+        conn.commit()
+        conn.execute("ANALYZE")
+        conn.commit()
+
+    def close(self):
+        """コミットして接続を閉じる"""
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
     def _init_db(self):
         """データベースとテーブルの初期化"""
         # ディレクトリが必要な場合のみ作成
@@ -29,7 +243,7 @@ class StockDatabase:
         if db_dir:
             os.makedirs(db_dir, exist_ok=True)
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self._begin()
         cursor = conn.cursor()
         
         # 株価テーブル
@@ -80,6 +294,7 @@ class StockDatabase:
         # インデックス
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_date ON prices(date)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_code ON prices(code)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_prices_code_date ON prices(code, date)")
         
         # シグナル履歴テーブル（評価機能用）
         cursor.execute("""
@@ -100,83 +315,104 @@ class StockDatabase:
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_signals_date ON signals(signal_date)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_signals_verdict ON signals(verdict)")
         
+        # ニュース検索結果キャッシュ（同日の再実行でAPIを呼ばない）
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS news_cache (
+                name TEXT,
+                search_date TEXT,
+                hits TEXT,
+                fetched_at INTEGER,
+                PRIMARY KEY (name, search_date)
+            )
+        """)
+        
+        # スキャン用インデックス（既存DBの fundamentals にも作成）
+        ensure_scan_indexes(conn)
+        
         conn.commit()
-        conn.close()
 
     def save_daily_quotes(self, df):
-        """日足データを保存（UPSERT）"""
+        """
+        日足データを保存（既存の (date, code) は無視）
+        
+        コミットは呼び出し側（commit() / close()）でまとめて行う。
+        失敗時はこの呼び出し分だけを取り消して例外を再送出する
+        （途中までの行が後続のコミットで保存され、その日が完了扱いになるのを防ぐ）。
+        """
         if df is None or df.empty:
             return 0
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self._begin()
+        # 未コミットの前日までの分は残すため、トランザクション全体ではなくセーブポイントまで戻す
+        conn.execute("SAVEPOINT save_daily_quotes")
         try:
-            # INSERT OR REPLACE for upsert
-            df.to_sql('prices', conn, if_exists='append', index=False)
-            return len(df)
-        except sqlite3.IntegrityError:
-            # 重複キーの場合は無視
-            return 0
+            # スキーマ順の列に揃え、タプルのまま直接バインド（欠損列はNULL）
+            rows = df.reindex(columns=PRICE_COLUMNS).itertuples(index=False, name=None)
+            cursor = conn.executemany(_INSERT_PRICES_SQL, rows)
+            # 重複キーの行は無視（バッチ全体は捨てない）
+            count = cursor.rowcount
         except Exception as e:
+            conn.execute("ROLLBACK TO save_daily_quotes")
+            conn.execute("RELEASE save_daily_quotes")
             print(f"[DB] Error saving prices: {e}")
-            return 0
-        finally:
-            conn.close()
+            raise
+        conn.execute("RELEASE save_daily_quotes")
+        return count
 
     def save_fundamentals(self, df):
         """財務情報を保存"""
         if df is None or df.empty:
             return 0
         
-        conn = sqlite3.connect(self.db_path)
+        conn = self._begin()
         try:
             # 既存データを置き換え
             df.to_sql('fundamentals', conn, if_exists='replace', index=False)
+            # 置き換えでインデックスも消えるため作り直す
+            ensure_scan_indexes(conn)
+            conn.commit()
             return len(df)
         except Exception as e:
+            conn.rollback()
             print(f"[DB] Error saving fundamentals: {e}")
             return 0
-        finally:
-            conn.close()
 
     def get_sync_progress(self, table_name):
         """同期進捗を取得"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._get_conn().cursor()
         cursor.execute(
             "SELECT last_synced_date FROM sync_progress WHERE table_name = ?",
             (table_name,)
         )
         result = cursor.fetchone()
-        conn.close()
         return result[0] if result else None
 
     def update_sync_progress(self, table_name, synced_date):
-        """同期進捗を更新"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """
+        同期進捗を更新
+        
+        株価と同じトランザクションでコミットされるよう、ここではコミットしない。
+        """
+        cursor = self._begin().cursor()
         cursor.execute(
             "INSERT OR REPLACE INTO sync_progress (table_name, last_synced_date) VALUES (?, ?)",
             (table_name, synced_date)
         )
-        conn.commit()
-        conn.close()
 
     def get_price_count(self):
         """株価レコード数を取得"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._get_conn().cursor()
         cursor.execute("SELECT COUNT(*) FROM prices")
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        return cursor.fetchone()[0]
 
-    def save_signals(self, signal_list, signal_date):
+    def save_signals(self, signal_list, signal_date, commit=True):
         """
         シグナルリストをDBに保存（UPSERT）
         
         Args:
             signal_list: シグナル辞書のリスト
             signal_date: シグナル発生日（YYYY-MM-DD形式）
+            commit: Falseの場合はコミットせず、呼び出し側の commit() でまとめて確定
         
         Returns:
             int: 保存したレコード数
@@ -184,35 +420,93 @@ class StockDatabase:
         if not signal_list:
             return 0
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        saved = 0
+        # 先に全行をバインド用タプルへ変換（不正な行はここで除外）
+        rows = []
         for sig in signal_list:
             try:
-                cursor.execute("""
-                    INSERT OR REPLACE INTO signals 
-                    (signal_date, code, name, signal_price, ma25_rate, stop_loss, take_profit, verdict, reason, news_hit)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
+                rows.append((
                     signal_date,
                     str(sig.get('code', '')),
                     str(sig.get('name', '')),
-                    sig.get('current_price', 0),
-                    sig.get('ma25_rate', 0.0),
-                    sig.get('stop_loss', 0),
-                    sig.get('take_profit', 0),
+                    float(sig.get('current_price', 0) or 0),
+                    float(sig.get('ma25_rate', 0.0) or 0.0),
+                    float(sig.get('stop_loss', 0) or 0),
+                    float(sig.get('take_profit', 0) or 0),
                     str(sig.get('verdict', 'N/A')),
                     str(sig.get('reason', '')),
                     str(sig.get('news_hit', '') or '')
                 ))
-                saved += 1
-            except Exception as e:
+            except (TypeError, ValueError) as e:
                 print(f"[DB] Error saving signal {sig.get('code')}: {e}")
         
+        if not rows:
+            return 0
+        
+        conn = self._begin()
+        # 1トランザクションでまとめて書き込む
+        try:
+            conn.executemany("""
+                INSERT OR REPLACE INTO signals 
+                (signal_date, code, name, signal_price, ma25_rate, stop_loss, take_profit, verdict, reason, news_hit)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+        except Exception:
+            conn.rollback()
+            raise
+        if commit:
+            conn.commit()
+        return len(rows)
+
+    def get_news_cache(self, names, search_date, max_age_sec):
+        """
+        キャッシュ済みのニュース検索結果を取得
+        
+        Args:
+            names: 銘柄名のリスト
+            search_date: 検索日（YYYY-MM-DD）
+            max_age_sec: これより古いキャッシュは無視する秒数
+        
+        Returns:
+            dict: {銘柄名: ヒットしたニュースのリスト}
+        """
+        if not names:
+            return {}
+        
+        placeholders = ','.join('?' * len(names))
+        cursor = self._get_conn().execute(
+            f"SELECT name, hits FROM news_cache "
+            f"WHERE search_date = ? AND fetched_at >= ? AND name IN ({placeholders})",
+            [search_date, int(time.time()) - max_age_sec, *names]
+        )
+        return {name: json.loads(hits) for name, hits in cursor.fetchall()}
+
+    def save_news_cache(self, hits_by_name, search_date):
+        """
+        ニュース検索結果をキャッシュに保存（UPSERT）
+        
+        Args:
+            hits_by_name: {銘柄名: ヒットしたニュースのリスト}
+            search_date: 検索日（YYYY-MM-DD）
+        """
+        if not hits_by_name:
+            return 0
+        
+        fetched_at = int(time.time())
+        rows = [
+            (name, search_date, json.dumps(hits, ensure_ascii=False), fetched_at)
+            for name, hits in hits_by_name.items()
+        ]
+        conn = self._begin()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO news_cache (name, search_date, hits, fetched_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+        except Exception:
+            conn.rollback()
+            raise
         conn.commit()
-        conn.close()
-        return saved
+        return len(rows)
 
     def get_signals(self, start_date=None, end_date=None, verdict=None):
         """
@@ -226,8 +520,7 @@ class StockDatabase:
         Returns:
             list: シグナル辞書のリスト
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._get_conn().cursor()
         
         query = "SELECT * FROM signals WHERE 1=1"
         params = []
@@ -247,6 +540,5 @@ class StockDatabase:
         cursor.execute(query, params)
         columns = [desc[0] for desc in cursor.description]
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(zip(columns, row)) for row in rows]
\ No newline at end of file
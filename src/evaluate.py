@@ -14,11 +14,17 @@ import numpy as np
 from pathlib import Path
 from datetime import datetime, timedelta
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from src.database import apply_read_pragmas, open_readonly, read_sql_columns
 
 # --- Config ---
 DB_PATH = Path(__file__).parent.parent / "stock_data.db"
 CHARTS_OUTPUT_DIR = Path(__file__).parent.parent / "charts"
 EVAL_DAYS = 20  # シグナル後N営業日で評価
+CHART_WORKERS = None  # チャート描画のプロセス数（None: CPUコア数）
+# 調整後株価は小数を含むため整数化せずfloat32で保持（チャート用途には十分な精度）
+PRICE_DTYPES = {'open': np.float32, 'high': np.float32, 'low': np.float32, 'close': np.float32}
 
 
 def load_signals(year_month: str) -> pd.DataFrame:
@@ -31,15 +37,19 @@ def load_signals(year_month: str) -> pd.DataFrame:
     Returns:
         DataFrame: シグナルデータ
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_readonly(DB_PATH)
+    
+    # 前方一致LIKEではなく範囲指定にして idx_signals_date を使わせる
+    start_date = f"{year_month}-01"
+    end_date = (pd.Timestamp(start_date) + pd.offsets.MonthEnd(1)).strftime('%Y-%m-%d')
     
     query = """
     SELECT * FROM signals 
-    WHERE signal_date LIKE ?
+    WHERE signal_date BETWEEN ? AND ?
     ORDER BY signal_date, code
     """
     
-    df = pd.read_sql(query, conn, params=[f"{year_month}%"])
+    df = pd.read_sql(query, conn, params=[start_date, end_date])
     conn.close()
     
     if df.empty:
@@ -65,7 +75,7 @@ def load_prices_for_evaluation(codes: list, start_date: str, end_date: str) -> p
     if not codes:
         return pd.DataFrame()
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_readonly(DB_PATH)
     
     placeholders = ','.join('?' * len(codes))
     query = f"""
@@ -78,12 +88,67 @@ def load_prices_for_evaluation(codes: list, start_date: str, end_date: str) -> p
     """
     
     params = list(codes) + [start_date, end_date]
-    df = pd.read_sql(query, conn, params=params, parse_dates=['date'])
+    df = read_sql_columns(conn, query, params, dtypes=PRICE_DTYPES, parse_dates=['date'])
     conn.close()
     
     return df
 
 
+def _split_prices_by_code(prices_df: pd.DataFrame) -> dict:
+    """
+    株価データを銘柄ごとのNumPy配列に分割（code, date順に並んでいる前提）
+    
+    Returns:
+        dict: {code: {'date': ndarray, 'open': ndarray, ...}}
+    """
+    columns = ['date', 'open', 'high', 'low', 'close']
+    return {
+        code: {col: group[col].to_numpy() for col in columns}
+        for code, group in prices_df.groupby('code', sort=False)
+    }
+
+
+def _query_eval_window(conn, signals_df: pd.DataFrame, eval_days: int, max_date: str) -> pd.DataFrame:
+    """
+    シグナル翌営業日からeval_days営業日分の株価をSQLのウィンドウ関数で集計
+    
+    シグナルを一時テーブルに入れて prices と結合し、
+    ROW_NUMBER() で各シグナルの営業日番号を振ってから集計する。
+    
+    Returns:
+        DataFrame: idx（signals_dfの行番号）, first_open, eval_price, max_high, min_low
+    """
+    conn.execute("DROP TABLE IF EXISTS tmp_sig")
+    conn.execute("CREATE TEMP TABLE tmp_sig (idx INTEGER PRIMARY KEY, code TEXT, signal_date TEXT)")
+    signal_dates = pd.to_datetime(signals_df['signal_date']).dt.strftime('%Y-%m-%d')
+    conn.executemany(
+        "INSERT INTO tmp_sig VALUES (?, ?, ?)",
+        zip(range(len(signals_df)), signals_df['code'].astype(str), signal_dates)
+    )
+    
+    query = """
+    WITH future AS (
+        SELECT s.idx, p.open, p.high, p.low, p.close,
+               ROW_NUMBER() OVER (PARTITION BY s.idx ORDER BY p.date) AS rn
+        FROM tmp_sig s
+        JOIN prices p ON p.code = s.code AND p.date > s.signal_date AND p.date <= ?
+    ),
+    eval_window AS (
+        SELECT *, COUNT(*) OVER (PARTITION BY idx) AS n_days
+        FROM future
+        WHERE rn <= ?
+    )
+    SELECT idx,
+           MAX(CASE WHEN rn = 1 THEN open END) AS first_open,
+           MAX(CASE WHEN rn = n_days THEN close END) AS eval_price,
+           MAX(high) AS max_high,
+           MIN(low) AS min_low
+    FROM eval_window
+    GROUP BY idx
+    """
+    return pd.read_sql(query, conn, params=[max_date, eval_days])
+
+
 def calculate_performance(signals_df: pd.DataFrame, eval_days: int = EVAL_DAYS) -> pd.DataFrame:
     """
     シグナル後N日のパフォーマンスを計算
@@ -98,76 +163,46 @@ def calculate_performance(signals_df: pd.DataFrame, eval_days: int = EVAL_DAYS)
     if signals_df.empty:
         return signals_df
     
-    # 評価期間を計算
-    min_date = pd.to_datetime(signals_df['signal_date'].min())
+    # 評価期間を計算（従来どおりシグナル日からeval_days*2暦日までの株価で評価）
     max_eval_date = (pd.to_datetime(signals_df['signal_date'].max()) + timedelta(days=eval_days * 2)).strftime('%Y-%m-%d')
     
-    # 株価データ取得
-    codes = signals_df['code'].unique().tolist()
-    prices_df = load_prices_for_evaluation(codes, min_date.strftime('%Y-%m-%d'), max_eval_date)
+    # シグナルごとの初日始値・N日後終値・期間高値/安値をSQL側で集計
+    # 一時テーブルを使うため参照専用ではない接続で開く
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        apply_read_pragmas(conn)
+        window = _query_eval_window(conn, signals_df, eval_days, max_eval_date)
+    finally:
+        conn.close()
     
-    if prices_df.empty:
+    if window.empty:
         print("[WARN] No price data found for evaluation")
         signals_df['return_pct'] = np.nan
         signals_df['max_gain'] = np.nan
         signals_df['max_loss'] = np.nan
         return signals_df
     
-    # 各シグナルに対してパフォーマンスを計算
-    results = []
-    
-    for _, sig in signals_df.iterrows():
-        code = sig['code']
-        signal_date = pd.to_datetime(sig['signal_date'])
-        
-        # 該当銘柄の株価を取得
-        code_prices = prices_df[prices_df['code'] == code].copy()
-        if code_prices.empty:
-            results.append({
-                **sig.to_dict(),
-                'return_pct': np.nan,
-                'max_gain': np.nan,
-                'max_loss': np.nan,
-                'eval_price': np.nan
-            })
-            continue
-        
-        # シグナル日以降のデータ
-        future_prices = code_prices[code_prices['date'] > signal_date].head(eval_days)
-        
-        if future_prices.empty:
-            results.append({
-                **sig.to_dict(),
-                'return_pct': np.nan,
-                'max_gain': np.nan,
-                'max_loss': np.nan,
-                'eval_price': np.nan
-            })
-            continue
-        
-        signal_price = sig['signal_price']
-        if signal_price <= 0:
-            signal_price = future_prices.iloc[0]['open']
-        
-        # N日後の終値でリターン計算
-        eval_price = future_prices.iloc[-1]['close']
-        return_pct = (eval_price - signal_price) / signal_price * 100
-        
-        # 期間中の最大上昇/下落
-        max_high = future_prices['high'].max()
-        min_low = future_prices['low'].min()
-        max_gain = (max_high - signal_price) / signal_price * 100
-        max_loss = (min_low - signal_price) / signal_price * 100
-        
-        results.append({
-            **sig.to_dict(),
-            'return_pct': round(return_pct, 2),
-            'max_gain': round(max_gain, 2),
-            'max_loss': round(max_loss, 2),
-            'eval_price': eval_price
-        })
-    
-    return pd.DataFrame(results)
+    # シグナル行の並びに揃える（株価がないシグナルはNaN）
+    window = window.set_index('idx').reindex(np.arange(len(signals_df)))
+    first_open = window['first_open'].to_numpy(dtype=np.float64)
+    eval_price = window['eval_price'].to_numpy(dtype=np.float64)
+    max_high = window['max_high'].to_numpy(dtype=np.float64)
+    min_low = window['min_low'].to_numpy(dtype=np.float64)
+    
+    signal_price = signals_df['signal_price'].to_numpy(dtype=np.float64)
+    signal_price = np.where(signal_price <= 0, first_open, signal_price)
+    
+    # N日後の終値でリターン計算、期間中の最大上昇/下落
+    return_pct = (eval_price - signal_price) / signal_price * 100
+    max_gain = (max_high - signal_price) / signal_price * 100
+    max_loss = (min_low - signal_price) / signal_price * 100
+    
+    results = signals_df.copy()
+    results['return_pct'] = np.round(return_pct, 2)
+    results['max_gain'] = np.round(max_gain, 2)
+    results['max_loss'] = np.round(max_loss, 2)
+    results['eval_price'] = eval_price
+    return results
 
 
 def generate_report(year_month: str, eval_days: int = EVAL_DAYS):
@@ -191,69 +226,125 @@ def generate_report(year_month: str, eval_days: int = EVAL_DAYS):
     # パフォーマンス計算
     results_df = calculate_performance(signals_df, eval_days)
     
-    # 判定別集計
+    # 判定別集計（統計量は判定ごとに1回のgroupbyでまとめて計算）
+    counts = results_df['verdict'].value_counts()
+    valid_df = results_df.dropna(subset=['return_pct'])
+    returns = valid_df['return_pct']
+    stats = returns.groupby(valid_df['verdict']).agg(['mean', 'median', 'max', 'min', 'count'])
+    stats['plus_rate'] = (returns > 0).groupby(valid_df['verdict']).mean() * 100
+    stats['minus_rate'] = (returns < 0).groupby(valid_df['verdict']).mean() * 100
+    valid_groups = dict(tuple(valid_df.groupby('verdict')))
+    
     for verdict in ['ENTRY', 'WATCH', 'REJECT']:
-        subset = results_df[results_df['verdict'] == verdict]
-        if subset.empty:
+        if verdict not in counts.index:
             continue
         
-        valid_subset = subset.dropna(subset=['return_pct'])
-        
-        print(f"\n■ {verdict}判定 ({len(subset)}件)")
+        print(f"\n■ {verdict}判定 ({counts[verdict]}件)")
         print("-" * 40)
         
-        if valid_subset.empty:
+        if verdict not in stats.index:
             print("  評価データなし（株価データ不足）")
             continue
+        row = stats.loc[verdict]
         
         # 的中率/回避成功率
         if verdict == 'ENTRY':
-            hit_rate = (valid_subset['return_pct'] > 0).mean() * 100
-            print(f"  的中率（プラス終了）: {hit_rate:.1f}%")
+            print(f"  的中率（プラス終了）: {row['plus_rate']:.1f}%")
         elif verdict == 'REJECT':
-            avoid_rate = (valid_subset['return_pct'] < 0).mean() * 100
-            print(f"  回避成功率（マイナス終了）: {avoid_rate:.1f}%")
+            print(f"  回避成功率（マイナス終了）: {row['minus_rate']:.1f}%")
         else:
-            plus_rate = (valid_subset['return_pct'] > 0).mean() * 100
-            print(f"  プラス終了率: {plus_rate:.1f}%")
+            print(f"  プラス終了率: {row['plus_rate']:.1f}%")
         
         # リターン統計
-        avg_return = valid_subset['return_pct'].mean()
-        median_return = valid_subset['return_pct'].median()
-        max_return = valid_subset['return_pct'].max()
-        min_return = valid_subset['return_pct'].min()
-        
-        print(f"  平均リターン: {avg_return:+.2f}%")
-        print(f"  中央値: {median_return:+.2f}%")
-        print(f"  最大: {max_return:+.2f}% / 最小: {min_return:+.2f}%")
+        print(f"  平均リターン: {row['mean']:+.2f}%")
+        print(f"  中央値: {row['median']:+.2f}%")
+        print(f"  最大: {row['max']:+.2f}% / 最小: {row['min']:+.2f}%")
         
         # 上位/下位銘柄
-        if len(valid_subset) >= 3:
+        if row['count'] >= 3:
+            valid_subset = valid_groups[verdict]
             print("\n  [TOP 3]")
-            for _, row in valid_subset.nlargest(3, 'return_pct').iterrows():
-                print(f"    {row['code']} {row['name'][:10]}: {row['return_pct']:+.1f}%")
+            for sig in valid_subset.nlargest(3, 'return_pct').itertuples(index=False):
+                print(f"    {sig.code} {sig.name[:10]}: {sig.return_pct:+.1f}%")
             
             print("  [BOTTOM 3]")
-            for _, row in valid_subset.nsmallest(3, 'return_pct').iterrows():
-                print(f"    {row['code']} {row['name'][:10]}: {row['return_pct']:+.1f}%")
+            for sig in valid_subset.nsmallest(3, 'return_pct').itertuples(index=False):
+                print(f"    {sig.code} {sig.name[:10]}: {sig.return_pct:+.1f}%")
     
     print("\n" + "=" * 60)
     
     return results_df
 
 
+# ワーカープロセスごとに使い回すFigure（pyplotの管理下に置かない）
+_CHART_FIGURE = None
+
+
+def _chart_axes():
+    """チャート用のFigure/Axesを取得（初回のみ作成し、以降はAxesをクリアして再利用）"""
+    global _CHART_FIGURE
+    if _CHART_FIGURE is None:
+        import matplotlib
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        matplotlib.rcParams['font.family'] = 'MS Gothic'  # 日本語フォント
+        
+        _CHART_FIGURE = Figure(figsize=(10, 5))
+        FigureCanvasAgg(_CHART_FIGURE)
+        _CHART_FIGURE.add_subplot()
+    
+    ax = _CHART_FIGURE.axes[0]
+    ax.cla()
+    return _CHART_FIGURE, ax
+
+
+def _render_chart(task) -> None:
+    """
+    1銘柄分のチャートをPNGに保存（ProcessPoolExecutorのワーカーで実行）
+    
+    Args:
+        task: (filepath, title, title_color, signal_date, chart_data)
+    """
+    import matplotlib.dates as mdates
+    
+    filepath, title, title_color, signal_date, chart_data = task
+    
+    fig, ax = _chart_axes()
+    
+    # ローソク足（簡易版：終値折れ線）
+    ax.plot(chart_data['date'], chart_data['close'], 'b-', linewidth=1.5)
+    ax.fill_between(chart_data['date'], chart_data['low'], chart_data['high'], alpha=0.3)
+    
+    # シグナル日に縦線
+    ax.axvline(x=signal_date, color='red', linestyle='--', linewidth=2, label='Signal Date')
+    
+    ax.set_title(title, fontsize=12, color=title_color)
+    
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Price')
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
+    ax.xaxis.set_major_locator(mdates.WeekdayLocator(interval=1))
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+    
+    fig.tight_layout()
+    fig.savefig(filepath, dpi=100)
+
+
 def plot_signal_charts(results_df: pd.DataFrame, output_dir: Path = CHARTS_OUTPUT_DIR):
     """
     各シグナルの日足チャートをPNG出力
     
+    描画（Aggのラスタライズ）はCPU処理でGILを手放さないため、
+    プロセスプールで並列に実行する。
+    
     Args:
         results_df: 評価結果データ
         output_dir: 出力ディレクトリ
     """
     try:
-        import matplotlib.pyplot as plt
-        import matplotlib.dates as mdates
-        plt.rcParams['font.family'] = 'MS Gothic'  # 日本語フォント
+        import matplotlib  # noqa: F401
     except ImportError:
         print("[ERROR] matplotlib not installed. Run: pip install matplotlib")
         return
@@ -275,64 +366,91 @@ def plot_signal_charts(results_df: pd.DataFrame, output_dir: Path = CHARTS_OUTPU
         print("[WARN] No price data for charts")
         return
     
-    chart_count = 0
+    # 銘柄ごとの株価配列（ループ内で全件を毎回フィルタしない）
+    price_groups = _split_prices_by_code(prices_df)
+    
+    # 判定結果に応じた色
+    verdict_colors = {'ENTRY': 'green', 'WATCH': 'orange', 'REJECT': 'red'}
     
-    for _, sig in results_df.iterrows():
-        code = sig['code']
-        signal_date = pd.to_datetime(sig['signal_date'])
-        verdict = sig['verdict']
-        name = sig['name'][:15] if sig['name'] else code
+    # 描画タスク（ワーカーに渡せるよう文字列とNumPy配列のみ）を作成
+    tasks = []
+    # 行アクセスのみなのでSeries化しないitertuplesで走査
+    for sig in results_df.itertuples(index=False):
+        code = sig.code
+        signal_date = pd.to_datetime(sig.signal_date)
+        verdict = sig.verdict
+        name = sig.name[:15] if sig.name else code
         
         # 該当銘柄のデータ
-        code_prices = prices_df[prices_df['code'] == code].copy()
-        
-        # シグナル日の前後20営業日を抽出
-        before = code_prices[code_prices['date'] < signal_date].tail(20)
-        after = code_prices[code_prices['date'] >= signal_date].head(21)
-        chart_data = pd.concat([before, after])
-        
-        if len(chart_data) < 5:
+        group = price_groups.get(code)
+        if group is None:
             continue
         
-        # チャート作成
-        fig, ax = plt.subplots(figsize=(10, 5))
-        
-        # ローソク足（簡易版：終値折れ線）
-        ax.plot(chart_data['date'], chart_data['close'], 'b-', linewidth=1.5)
-        ax.fill_between(chart_data['date'], chart_data['low'], chart_data['high'], alpha=0.3)
+        # シグナル日の前後20営業日を抽出（日付順なので連続区間になる）
+        pos = np.searchsorted(group['date'], signal_date.to_datetime64(), side='left')
+        chart = slice(max(pos - 20, 0), min(pos + 21, len(group['date'])))
+        chart_data = {col: values[chart] for col, values in group.items()}
         
-        # シグナル日に縦線
-        ax.axvline(x=signal_date, color='red', linestyle='--', linewidth=2, label='Signal Date')
-        
-        # 判定結果に応じた色
-        verdict_colors = {'ENTRY': 'green', 'WATCH': 'orange', 'REJECT': 'red'}
-        title_color = verdict_colors.get(verdict, 'black')
-        
-        return_str = f"{sig.get('return_pct', 0):+.1f}%" if pd.notna(sig.get('return_pct')) else "N/A"
-        ax.set_title(f"[{verdict}] {code} {name} (Return: {return_str})", fontsize=12, color=title_color)
-        
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Price')
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
-        ax.xaxis.set_major_locator(mdates.WeekdayLocator(interval=1))
-        plt.xticks(rotation=45)
-        ax.legend()
-        ax.grid(True, alpha=0.3)
+        if len(chart_data['date']) < 5:
+            continue
         
-        plt.tight_layout()
+        return_pct = getattr(sig, 'return_pct', np.nan)
+        return_str = f"{return_pct:+.1f}%" if pd.notna(return_pct) else "N/A"
+        title = f"[{verdict}] {code} {name} (Return: {return_str})"
         
         # 保存（ファイル名の不正文字をサニタイズ）
         safe_verdict = verdict.replace('/', '_').replace('\\', '_').replace(':', '_')
-        filename = f"{sig['signal_date']}_{code}_{safe_verdict}.png"
-        filepath = output_dir / filename
-        plt.savefig(filepath, dpi=100)
-        plt.close()
-        
-        chart_count += 1
+        filename = f"{sig.signal_date}_{code}_{safe_verdict}.png"
+        tasks.append((
+            str(output_dir / filename), title, verdict_colors.get(verdict, 'black'),
+            signal_date, chart_data
+        ))
+    
+    chart_count = 0
+    if tasks:
+        with ProcessPoolExecutor(max_workers=CHART_WORKERS) as pool:
+            for _ in pool.map(_render_chart, tasks, chunksize=8):
+                chart_count += 1
     
     print(f"[INFO] Generated {chart_count} charts in {output_dir}")
 
 
+def _fetch_sheet_records(sh, worksheets: list) -> list:
+    """
+    複数シートの内容をまとめて取得し、シートごとの get_all_records() 相当のリストを返す
+    
+    values_batch_get で全シートを1回のAPI呼び出しで取得する。
+    values_batch_get がない古いgspreadではスレッドで並列に get_all_records() を呼ぶ。
+    """
+    if not worksheets:
+        return []
+    
+    if not hasattr(sh, 'values_batch_get'):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return list(pool.map(lambda ws: ws.get_all_records(), worksheets))
+    
+    from gspread.utils import numericise_all
+    
+    ranges = ["'{}'".format(ws.title.replace("'", "''")) for ws in worksheets]
+    response = sh.values_batch_get(ranges)
+    
+    all_records = []
+    for value_range in response.get('valueRanges', []):
+        values = value_range.get('values', [])
+        if len(values) < 2:
+            all_records.append([])
+            continue
+        # 1行目がヘッダー。get_all_records と同様に数値化し、欠けたセルは空文字で埋める
+        header = values[0]
+        records = []
+        for row in values[1:]:
+            row = numericise_all(row + [''] * (len(header) - len(row)), default_blank='')
+            records.append(dict(zip(header, row)))
+        all_records.append(records)
+    return all_records
+
+
 def import_from_sheets():
     """
     Google Sheetsの過去シート（Signals_YYYYMMDD）からシグナルをインポート
@@ -373,17 +491,21 @@ def import_from_sheets():
     
     total_imported = 0
     
+    # シート名から日付を抽出
+    dated_sheets = []
     for ws in signal_sheets:
-        # シート名から日付を抽出
         date_str = ws.title.replace('Signals_', '')
         try:
             signal_date = datetime.strptime(date_str, '%Y%m%d').strftime('%Y-%m-%d')
         except ValueError:
             print(f"[WARN] Invalid sheet name: {ws.title}")
             continue
-        
-        # データ取得
-        records = ws.get_all_records()
+        dated_sheets.append((ws, signal_date))
+    
+    # データ取得（全シートを1回のAPI呼び出しで）
+    all_records = _fetch_sheet_records(sh, [ws for ws, _ in dated_sheets])
+    
+    for (ws, signal_date), records in zip(dated_sheets, all_records):
         if not records:
             continue
         
@@ -406,10 +528,12 @@ def import_from_sheets():
             })
         
         if signals:
-            saved = db.save_signals(signals, signal_date)
+            # シートごとにはコミットせず、最後に1回だけ確定する
+            saved = db.save_signals(signals, signal_date, commit=False)
             total_imported += saved
             print(f"  {ws.title}: {saved} signals imported")
     
+    db.close()
     print(f"\n[INFO] Total imported: {total_imported} signals")
 
 
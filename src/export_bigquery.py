@@ -2,19 +2,22 @@
 BigQuery Export Script
 
 stock_data.dbのデータをBigQueryにエクスポートするためのスクリプト。
-1. SQLiteからDataFrameに読み込み
-2. BigQueryに直接アップロード
+1. SQLiteから分割読み込みしてParquetに書き出し
+2. BigQueryのロードジョブで取り込み
 
 前提条件:
-- pip install google-cloud-bigquery pandas-gbq
+- pip install google-cloud-bigquery pyarrow
 - gcloud auth application-default login（認証済み）
 - GCPプロジェクトでBigQuery APIを有効化
 """
-import sqlite3
-import pandas as pd
+import csv
+import tempfile
+import uuid
 from pathlib import Path
 from datetime import datetime
 
+from src.database import open_readonly
+
 # --- Config ---
 DB_PATH = Path(__file__).parent.parent / "stock_data.db"
 
@@ -24,6 +27,33 @@ BQ_DATASET = "stock_data"           # データセット名
 BQ_TABLE_PRICES = "prices"          # 株価テーブル
 BQ_TABLE_FUNDAMENTALS = "fundamentals"  # 銘柄マスタテーブル
 
+# パーティション・クラスタリング設定 {テーブル: (パーティション列, クラスタ列)}
+# 日次だと1回のロードで変更できるパーティション数の上限（4,000）を超えるため月単位
+BQ_PARTITIONING = {
+    BQ_TABLE_PRICES: ("date", ["code"]),
+}
+
+
+def write_table_csv(conn, table: str, path: Path, chunk_size: int = 100_000) -> int:
+    """
+    SQLiteのテーブルをカーソルから直接CSVに書き出す（DataFrameを経由しない）
+    
+    Returns:
+        int: 書き出した行数
+    """
+    cursor = conn.execute(f"SELECT * FROM {table}")
+    total = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow([desc[0] for desc in cursor.description])
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.writerows(rows)
+            total += len(rows)
+    return total
+
 
 def export_to_csv():
     """
@@ -33,21 +63,19 @@ def export_to_csv():
     print(f"Export to CSV - {datetime.now().strftime('%Y-%m-%d %H:%M')}")
     print("="*60)
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_readonly(DB_PATH)
     
     # prices テーブル
     print("[INFO] Exporting prices table...")
-    df_prices = pd.read_sql("SELECT * FROM prices", conn)
     csv_prices = DB_PATH.parent / "export_prices.csv"
-    df_prices.to_csv(csv_prices, index=False)
-    print(f"[INFO] Exported {len(df_prices)} records to {csv_prices}")
+    count = write_table_csv(conn, "prices", csv_prices)
+    print(f"[INFO] Exported {count} records to {csv_prices}")
     
     # fundamentals テーブル
     print("[INFO] Exporting fundamentals table...")
-    df_fundamentals = pd.read_sql("SELECT * FROM fundamentals", conn)
     csv_fundamentals = DB_PATH.parent / "export_fundamentals.csv"
-    df_fundamentals.to_csv(csv_fundamentals, index=False)
-    print(f"[INFO] Exported {len(df_fundamentals)} records to {csv_fundamentals}")
+    count = write_table_csv(conn, "fundamentals", csv_fundamentals)
+    print(f"[INFO] Exported {count} records to {csv_fundamentals}")
     
     conn.close()
     
@@ -62,14 +90,104 @@ def export_to_csv():
     print("="*60)
 
 
+# SQLiteの宣言型 -> Parquet(Arrow)型
+_ARROW_TYPES = {"TEXT": "string", "REAL": "float64", "INTEGER": "int64", "INT": "int64"}
+
+
+def _column_array(values, field, table: str):
+    """
+    1列分の値をArrow配列に変換（宣言型へ安全にキャスト）
+    
+    SQLiteは宣言型と異なる型の値も格納できるため（to_sqlで作られた表など）、
+    type= で押し込まず型推論してから safe=True でキャストする
+    （文字列列の数値・混在値は文字列化、INTEGER列の小数は切り捨てずにエラー）。
+    """
+    import pyarrow as pa
+    
+    try:
+        try:
+            inferred = pa.array(values, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # 型が混在する列は文字列列に限り文字列化（SQLiteのTEXT親和性と同じ扱い）
+            if not pa.types.is_string(field.type):
+                raise
+            inferred = pa.array([None if v is None else str(v) for v in values], type=pa.string())
+        return inferred.cast(field.type, safe=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+        raise ValueError(f"{table}.{field.name}: cannot convert to {field.type}: {e}") from e
+
+
+def write_table_parquet(conn, table: str, path: Path, chunk_size: int = 100_000, date_columns=(),
+                        where: str = "", params=()) -> int:
+    """
+    SQLiteのテーブルを分割取得しながらParquetファイルに書き出す
+    
+    全行をDataFrameに載せず、chunk_size行ずつArrowの行グループとして追記する。
+    列型はテーブル定義から決める（先頭チャンクが全NULLの列でも型がぶれない）。
+    
+    Args:
+        date_columns: DATE型で書き出す列（YYYY-MM-DD文字列を変換）
+        where: 行を絞り込むWHERE句（差分同期用、例: "WHERE date IN (?)"）
+        params: whereのバインドパラメータ
+    
+    Returns:
+        int: 書き出した行数
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    schema = pa.schema([
+        (name, pa.date32() if name in date_columns else pa.type_for_alias(_ARROW_TYPES.get(decl.upper(), "string")))
+        for _, name, decl, *_ in columns
+    ])
+    
+    cursor = conn.execute(f"SELECT {', '.join(schema.names)} FROM {table} {where}", list(params))
+    total = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            arrays = [_column_array(values, field, table) for field, values in zip(schema, zip(*rows))]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            total += len(rows)
+    return total
+
+
+def _drop_if_partitioning_differs(client, table_id: str, partitioning) -> None:
+    """
+    既存テーブルのパーティション設定が異なる場合は削除する
+    
+    WRITE_TRUNCATEでもパーティション仕様は変更できないため、
+    旧形式（パーティションなし）のテーブルは一度だけ作り直す。
+    ロード済みのステージングテーブルからコピーする直前に呼ぶこと。
+    """
+    from google.api_core.exceptions import NotFound
+    
+    try:
+        existing = client.get_table(table_id)
+    except NotFound:
+        return
+    
+    field, clustering_fields = partitioning
+    current = existing.time_partitioning
+    if (current is None or current.field != field or current.type_ != "MONTH"
+            or existing.clustering_fields != clustering_fields):
+        print(f"[INFO] Recreating {table_id} with partitioning on {field}")
+        client.delete_table(table_id)
+
+
 def export_to_bigquery():
     """
-    SQLiteからBigQueryに直接エクスポート（pandas-gbq使用）
+    SQLiteからBigQueryに直接エクスポート（Parquet経由のロードジョブ）
     """
     try:
-        import pandas_gbq
+        from google.cloud import bigquery
+        import pyarrow  # noqa: F401
     except ImportError:
-        print("[ERROR] pandas-gbq not installed. Run: pip install pandas-gbq")
+        print("[ERROR] google-cloud-bigquery / pyarrow not installed. "
+              "Run: pip install google-cloud-bigquery pyarrow")
         return
     
     if GCP_PROJECT_ID == "your-project-id":
@@ -82,38 +200,52 @@ def export_to_bigquery():
     print(f"Dataset: {BQ_DATASET}")
     print("="*60)
     
-    conn = sqlite3.connect(DB_PATH)
+    client = bigquery.Client(project=GCP_PROJECT_ID)
     
-    # prices テーブル
-    print("[INFO] Uploading prices table to BigQuery...")
-    df_prices = pd.read_sql("SELECT * FROM prices", conn)
-    
-    # カラム型を明示的に指定
-    df_prices['date'] = pd.to_datetime(df_prices['date']).dt.strftime('%Y-%m-%d')
-    
-    table_id = f"{BQ_DATASET}.{BQ_TABLE_PRICES}"
-    pandas_gbq.to_gbq(
-        df_prices,
-        destination_table=table_id,
-        project_id=GCP_PROJECT_ID,
-        if_exists='replace',  # 既存テーブルを置換
-        progress_bar=True
-    )
-    print(f"[INFO] Uploaded {len(df_prices)} records to {table_id}")
+    conn = open_readonly(DB_PATH)
     
-    # fundamentals テーブル
-    print("[INFO] Uploading fundamentals table to BigQuery...")
-    df_fundamentals = pd.read_sql("SELECT * FROM fundamentals", conn)
-    
-    table_id = f"{BQ_DATASET}.{BQ_TABLE_FUNDAMENTALS}"
-    pandas_gbq.to_gbq(
-        df_fundamentals,
-        destination_table=table_id,
-        project_id=GCP_PROJECT_ID,
-        if_exists='replace',
-        progress_bar=True
-    )
-    print(f"[INFO] Uploaded {len(df_fundamentals)} records to {table_id}")
+    with tempfile.TemporaryDirectory() as staging_dir:
+        for table in (BQ_TABLE_PRICES, BQ_TABLE_FUNDAMENTALS):
+            print(f"[INFO] Uploading {table} table to BigQuery...")
+            
+            table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}.{table}"
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,  # 既存テーブルを置換
+            )
+            
+            # 日付でパーティション分割・銘柄コードでクラスタリング（クエリ時のスキャン量を削減）
+            partitioning = BQ_PARTITIONING.get(table)
+            date_columns = ()
+            if partitioning:
+                field, clustering_fields = partitioning
+                job_config.time_partitioning = bigquery.TimePartitioning(
+                    type_=bigquery.TimePartitioningType.MONTH, field=field
+                )
+                job_config.clustering_fields = clustering_fields
+                date_columns = (field,)
+            
+            # ローカルでParquet(zstd)に書き出してからロードジョブで取り込む
+            parquet_path = Path(staging_dir) / f"{table}.parquet"
+            count = write_table_parquet(conn, table, parquet_path, date_columns=date_columns)
+            
+            # ステージングテーブルにロードしてからコピーで差し替える
+            # （読み込み・アップロード・ロードのどこで失敗しても既存テーブルは残る）
+            staging_id = f"{table_id}__staging_{uuid.uuid4().hex}"
+            try:
+                with open(parquet_path, "rb") as f:
+                    job = client.load_table_from_file(f, staging_id, job_config=job_config)
+                job.result()  # 完了を待つ
+                
+                if partitioning:
+                    _drop_if_partitioning_differs(client, table_id, partitioning)
+                copy_config = bigquery.CopyJobConfig(
+                    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                )
+                client.copy_table(staging_id, table_id, job_config=copy_config).result()
+            finally:
+                client.delete_table(staging_id, not_found_ok=True)
+            print(f"[INFO] Uploaded {count} records to {table_id}")
     
     conn.close()
     
@@ -0,0 +1,56 @@
+"""
+テクニカル指標の共通計算
+
+銘柄ごとの移動平均をまとめて計算する。bottleneckがあれば
+code順に並べ替えた1本の配列に move_mean を一括適用し、
+無い場合は pandas の groupby.rolling で計算する。
+"""
+
+import numpy as np
+import pandas as pd
+
+try:
+    import bottleneck as bn  # 高速な移動窓集計（任意）
+except ImportError:
+    bn = None
+
+
+def rolling_mean_by_code(df, window, column='close', dtype=np.float32):
+    """
+    銘柄ごとの単純移動平均を計算
+
+    各銘柄の行は日付昇順に並んでいる前提（groupby.rollingと同じ）。
+    window本そろうまではNaN。
+
+    Args:
+        df: 'code' と column を含むDataFrame
+        window: 移動平均の期間
+        column: 対象の列名
+        dtype: 戻り値の型
+
+    Returns:
+        np.ndarray: dfの行順に並んだ移動平均
+    """
+    if bn is None:
+        g = df.groupby('code', sort=False, observed=True)[column]
+        ma = g.rolling(window, min_periods=window).mean().droplevel(0)
+        return ma.reindex(df.index).to_numpy(dtype=dtype)
+
+    # code順（同一code内は元の順序を維持）に並べて1本の配列にする
+    code_ids = pd.factorize(df['code'])[0]
+    order = np.argsort(code_ids, kind='stable')
+    sorted_ids = code_ids[order]
+    values = df[column].to_numpy(dtype=np.float64)[order]
+
+    ma = bn.move_mean(values, window, min_count=window)
+
+    # 銘柄の境界をまたいだ窓を無効化（各銘柄の先頭 window-1 行）
+    n = len(sorted_ids)
+    is_start = np.ones(n, dtype=bool)
+    is_start[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    group_start = np.maximum.accumulate(np.where(is_start, np.arange(n), 0))
+    ma[np.arange(n) - group_start < window - 1] = np.nan
+
+    out = np.empty(n, dtype=dtype)
+    out[order] = ma
+    return out
@@ -9,9 +9,16 @@ Phase 2: Context Filter - 日経平均との比較（連れ安判定）
 Search Provider: Google Custom Search API (100回/日無料)
 """
 import os
+import re
+import unicodedata
 import requests
 import yfinance as yf
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
 from typing import Dict, Optional, List
 import logging
 from dotenv import load_dotenv
@@ -40,22 +47,53 @@ KILLER_KEYWORDS = [
     "倒産",
     "粉飾",
 ]
+# 全角/半角の表記揺れを吸収するためNFKC正規化したキーワード（KILLER_KEYWORDSの順＝重大度順）
+_KILLER_NORMALIZED = [(unicodedata.normalize("NFKC", k), k) for k in KILLER_KEYWORDS]
+# 全キーワードを1回の走査で検出する正規表現（ヒット有無の判定用）
+_KILLER_RE = re.compile("|".join(re.escape(nk) for nk, _ in _KILLER_NORMALIZED))
+
+# ニュース検索の並列数（HTTP待ちが大半のためスレッドで重ねる）
+NEWS_SEARCH_WORKERS = 10
+
+# CSE呼び出し用のセッション（keep-aliveでTLSハンドシェイクを使い回す）
+# 一時的なレートリミット(429)・5xxは指数バックオフで再試行し（Retry-Afterがあれば従う）、取りこぼしを防ぐ
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_maxsize=NEWS_SEARCH_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
+# 検索結果のキャッシュはDBの news_cache テーブルの1層のみ（キー: 銘柄名・検索日）
+# 同一プロセス内の重複も batch_analyze が銘柄名で重複排除してから引くため、メモリ上には持たない
+DB_PATH = Path(__file__).parent.parent / "stock_data.db"
+# DBキャッシュの有効期間（秒）。再実行・リトライ時はCSEを呼ばずに済ませる
+NEWS_CACHE_TTL = 24 * 60 * 60
 
 # 判定閾値
 MARKET_DROP_THRESHOLD = -2.0  # 市場が-2%以上下落で「地合い悪」
 SECTOR_DIP_THRESHOLD = -3.0   # 個別銘柄が-3%以上下落で「押し目候補」
 
 
+@lru_cache(maxsize=4)
+def _nikkei_change_cached(day: date) -> float:
+    """
+    日経平均の前日比を日付ごとに1回だけ取得
+    
+    失敗時は例外を送出するのでキャッシュされず、次回呼び出しで再取得する。
+    """
+    hist = yf.Ticker("^N225").history(period="5d")
+    if len(hist) < 2:
+        raise ValueError(f"insufficient history ({len(hist)} rows)")
+    prev_close = hist['Close'].iloc[-2]
+    last_close = hist['Close'].iloc[-1]
+    change_pct = (last_close / prev_close - 1) * 100
+    return round(change_pct, 2)
+
+
 def get_nikkei_change() -> float:
-    """日経平均の前日比（%）を取得"""
+    """日経平均の前日比（%）を取得（同じ日の2回目以降はキャッシュを返す）"""
     try:
-        nikkei = yf.Ticker("^N225")
-        hist = nikkei.history(period="5d")
-        if len(hist) >= 2:
-            prev_close = hist['Close'].iloc[-2]
-            last_close = hist['Close'].iloc[-1]
-            change_pct = (last_close / prev_close - 1) * 100
-            return round(change_pct, 2)
+        return _nikkei_change_cached(date.today())
     except Exception as e:
         logger.warning(f"[NEWS] Failed to get Nikkei data: {e}")
     return 0.0
@@ -72,9 +110,19 @@ def search_news_google(company_name: str, max_results: int = 3) -> List[dict]:
     Returns:
         ヒットしたニュースのリスト [{'title': str, 'keyword': str}, ...]
     """
+    return _search_news(company_name, max_results) or []
+
+
+def _search_news(company_name: str, max_results: int) -> Optional[List[dict]]:
+    """
+    search_news_google の本体
+    
+    Returns:
+        ヒットしたニュースのリスト。未設定・失敗時はNone（キャッシュに保存しない）
+    """
     if not GOOGLE_CSE_API_KEY or not GOOGLE_CSE_ID:
         logger.warning("[NEWS] Google CSE API key or ID not configured. Skipping search.")
-        return []
+        return None
     
     # 検索クエリ（銘柄名 + Killer Keywords）
     keywords_query = " OR ".join(KILLER_KEYWORDS[:5])  # 最初の5つのキーワード
@@ -93,7 +141,7 @@ def search_news_google(company_name: str, max_results: int = 3) -> List[dict]:
     
     hits = []
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = _session.get(url, params=params, timeout=10)
         response.raise_for_status()
         data = response.json()
         
@@ -103,22 +151,24 @@ def search_news_google(company_name: str, max_results: int = 3) -> List[dict]:
         for item in items:
             title = item.get("title", "")
             snippet = item.get("snippet", "")
-            text = title + " " + snippet
+            # 半角カナ等の表記揺れを正規化してから照合
+            text = unicodedata.normalize("NFKC", title + " " + snippet)
             
-            # Killer Keywordsを検出
-            for keyword in KILLER_KEYWORDS:
-                if keyword in text:
-                    hits.append({
-                        'title': title,
-                        'keyword': keyword,
-                        'link': item.get("link", ""),
-                    })
-                    break
+            # Killer Keywordsを検出（ヒットした記事のみ、リスト順で最も重大なキーワードを報告）
+            if _KILLER_RE.search(text):
+                keyword = next(k for nk, k in _KILLER_NORMALIZED if nk in text)
+                hits.append({
+                    'title': title,
+                    'keyword': keyword,
+                    'link': item.get("link", ""),
+                })
                     
     except requests.exceptions.RequestException as e:
         logger.warning(f"[NEWS] Google CSE request failed for {company_name}: {e}")
+        return None
     except Exception as e:
         logger.warning(f"[NEWS] Search failed for {company_name}: {e}")
+        return None
     
     return hits
 
@@ -127,7 +177,8 @@ def analyze_stock(
     code: str,
     name: str,
     stock_drop: float,
-    market_drop: Optional[float] = None
+    market_drop: Optional[float] = None,
+    news_hits: Optional[List[dict]] = None
 ) -> Dict:
     """
     銘柄を分析し、エントリー判定を行う
@@ -137,6 +188,7 @@ def analyze_stock(
         name: 銘柄名
         stock_drop: 対象銘柄の前日比（%）
         market_drop: 日経平均の前日比（%）、Noneの場合は自動取得
+        news_hits: 取得済みの検索結果、Noneの場合はここで検索
     
     Returns:
         {
@@ -151,7 +203,8 @@ def analyze_stock(
     
     # Phase 1: Event Filter（ニュース検索）
     logger.info(f"[NEWS] Analyzing {code} ({name})...")
-    news_hits = search_news_google(name, max_results=3)
+    if news_hits is None:
+        news_hits = search_news_google(name, max_results=3)
     
     if news_hits:
         # ネガティブニュース検出 → REJECT
@@ -201,13 +254,46 @@ def batch_analyze(signals: list) -> list:
     market_drop = get_nikkei_change()
     logger.info(f"[NEWS] Nikkei 225 change: {market_drop:+.1f}%")
     
+    names = list(dict.fromkeys(signal.get('name', '') for signal in signals))
+    today = date.today().isoformat()
+    
+    # 同日に検索済みの銘柄はDBキャッシュから取得（API呼び出しと1日100回の枠を節約）
+    db = None
+    hits_by_name = {}
+    try:
+        from src.database import StockDatabase
+        db = StockDatabase(DB_PATH)
+        hits_by_name = db.get_news_cache(names, today, NEWS_CACHE_TTL)
+        if hits_by_name:
+            logger.info(f"[NEWS] Loaded {len(hits_by_name)} cached search results")
+    except Exception as e:
+        logger.warning(f"[NEWS] News cache unavailable: {e}")
+    
+    # ニュース検索は銘柄ごとに独立しているので並列に実行
+    to_search = [name for name in names if name not in hits_by_name]
+    with ThreadPoolExecutor(max_workers=NEWS_SEARCH_WORKERS) as pool:
+        searched = dict(zip(to_search, pool.map(lambda n: _search_news(n, max_results=3), to_search)))
+    hits_by_name.update({name: hits or [] for name, hits in searched.items()})
+    
+    # 検索に成功した結果のみDBに保存（失敗時は次回再検索する）
+    if db is not None:
+        fresh = {name: hits for name, hits in searched.items() if hits is not None}
+        try:
+            db.save_news_cache(fresh, today)
+        except Exception as e:
+            logger.warning(f"[NEWS] Failed to save news cache: {e}")
+        finally:
+            db.close()
+    
     results = []
     for signal in signals:
+        name = signal.get('name', '')
         result = analyze_stock(
             code=signal['code'],
-            name=signal.get('name', ''),
+            name=name,
             stock_drop=signal.get('dip_pct', 0),
-            market_drop=market_drop
+            market_drop=market_drop,
+            news_hits=hits_by_name[name]
         )
         result['code'] = signal['code']
         results.append(result)
@@ -8,10 +8,13 @@ Google Sheets Notifier Module
 """
 import gspread
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict, Optional, Any
 import logging
+import numbers
 
 # --- Configuration ---
 # 認証キーはプロジェクトルートに配置することを想定
@@ -35,8 +38,29 @@ SCOPES = [
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 logger = logging.getLogger(__name__)
 
+# 認証済みクライアント（プロセス内で使い回し、鍵ファイルの読込・トークン発行を1回にする）
+_sheets_client: Optional[gspread.Client] = None
+
+def _mount_keepalive_adapter(client: gspread.Client) -> None:
+    """
+    gspreadのHTTPセッションに接続プール兼リトライ付きのアダプタを設定
+    
+    open_by_key → worksheet → update の連続呼び出しで同じTLS接続を使い回し、
+    一時的な429/5xxはバックオフして再試行する。
+    """
+    # gspread 6系は http_client.session、5系は client.session
+    session = getattr(getattr(client, "http_client", None), "session", None) or getattr(client, "session", None)
+    if session is None:
+        return
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+
 def get_sheets_client() -> Optional[gspread.Client]:
-    """Google Sheets APIクライアントを認証・取得する"""
+    """Google Sheets APIクライアントを認証・取得する（2回目以降はキャッシュを返す）"""
+    global _sheets_client
+    if _sheets_client is not None:
+        return _sheets_client
+    
     if not SECRET_KEY_PATH.exists():
         logger.error(f"[NOTIFIER] Secret key not found at: {SECRET_KEY_PATH}")
         logger.error("[NOTIFIER] Please ensure 'secret_key.json' is placed in the project root.")
@@ -45,11 +69,24 @@ def get_sheets_client() -> Optional[gspread.Client]:
     try:
         creds = Credentials.from_service_account_file(str(SECRET_KEY_PATH), scopes=SCOPES)
         client = gspread.authorize(creds)
-        return client
+        _mount_keepalive_adapter(client)
+        _sheets_client = client
+        return _sheets_client
     except Exception as e:
         logger.error(f"[NOTIFIER] Authentication failed: {e}")
         return None
 
+def _cell_value(value: Any) -> Dict[str, Any]:
+    """セル値をbatchUpdate用の CellData に変換（RAW入力と同じく文字列は解釈しない）"""
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, numbers.Real):  # numpyの数値型も含む
+        return {'userEnteredValue': {'numberValue': float(value)}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
 def update_signal_sheet(signal_data: List[Dict[str, Any]], spreadsheet_key: str = SPREADSHEET_KEY) -> bool:
     """
     シグナルリストをスプレッドシートに上書き保存する。
@@ -103,16 +140,27 @@ def update_signal_sheet(signal_data: List[Dict[str, Any]], spreadsheet_key: str
                 str(item.get('news_hit', '') or '')  # News Hit
             ])
             
-        # 既存データをクリアして書き込み
-        worksheet.clear()
-        
         if rows:
             # ヘッダー + データ
-            worksheet.update(range_name='A1', values=[header] + rows)
-            logger.info(f"[NOTIFIER] Successfully updated sheet with {len(rows)} signals.")
+            values = [header] + rows
         else:
             # データが無い場合もヘッダーだけは残す
-            worksheet.update(range_name='A1', values=[header, ["(No signals today)"]])
+            values = [header, ["(No signals today)"]]
+        
+        # clear() + update() の2往復にせず、値の消去と書き込みを1回のbatchUpdateで行う
+        # （シート全体を空文字で埋めて送ると、グリッドの大きさに比例してセル数が増える）
+        sh.batch_update({'requests': [
+            {'updateCells': {'range': {'sheetId': worksheet.id}, 'fields': 'userEnteredValue'}},
+            {'updateCells': {
+                'start': {'sheetId': worksheet.id, 'rowIndex': 0, 'columnIndex': 0},
+                'rows': [{'values': [_cell_value(v) for v in row]} for row in values],
+                'fields': 'userEnteredValue',
+            }},
+        ]})
+        
+        if rows:
+            logger.info(f"[NOTIFIER] Successfully updated sheet with {len(rows)} signals.")
+        else:
             logger.info("[NOTIFIER] No signals to report. Sheet cleared.")
 
         return True
@@ -9,6 +9,8 @@ import numpy as np
 from pathlib import Path
 from datetime import datetime
 
+from src.database import apply_read_pragmas
+
 # --- Config (Golden Configuration) ---
 DB_PATH = Path(__file__).parent.parent / "stock_data.db"
 DIP_THRESHOLD = 0.97       # 押し目
@@ -23,14 +25,38 @@ SCALECAT_TARGETS = ['TOPIX Small 1', 'TOPIX Small 2', 'TOPIX Mid400']
 ENABLE_SHEETS_NOTIFICATION = True
 
 
-def calculate_rsi(series, period=14):
-    """RSI (Relative Strength Index) を計算"""
-    delta = series.diff()
+def rolling_mean_by(series, groups, window):
+    """
+    グループ（銘柄）ごとの移動平均
+    
+    groupby.transform(lambda ...) と違い、グループごとにPythonを呼ばず
+    pandasのgroupby.rolling（C実装）で一括計算する。元のインデックスに揃えて返す。
+    """
+    return series.groupby(groups, sort=False, observed=True).rolling(window).mean().reset_index(level=0, drop=True)
+
+
+def calculate_rsi(series, period=14, groups=None):
+    """
+    RSI (Relative Strength Index) を計算
+    
+    Args:
+        series: 終値
+        period: 期間
+        groups: 銘柄コード等のキー。指定時はグループごとに計算する
+    """
+    if groups is None:
+        delta = series.diff()
+    else:
+        delta = series.groupby(groups, sort=False, observed=True).diff()
     gain = (delta.where(delta > 0, 0)).fillna(0)
     loss = (-delta.where(delta < 0, 0)).fillna(0)
     
-    avg_gain = gain.rolling(window=period).mean()
-    avg_loss = loss.rolling(window=period).mean()
+    if groups is None:
+        avg_gain = gain.rolling(window=period).mean()
+        avg_loss = loss.rolling(window=period).mean()
+    else:
+        avg_gain = rolling_mean_by(gain, groups, period)
+        avg_loss = rolling_mean_by(loss, groups, period)
     
     rs = avg_gain / avg_loss
     rsi = 100 - (100 / (1 + rs))
@@ -49,6 +75,7 @@ def analyze_market():
         return
         
     conn = sqlite3.connect(db_path)
+    apply_read_pragmas(conn)
     
     print("[INFO] Loading recent data...")
     
@@ -65,46 +92,53 @@ def analyze_market():
     
     # データ取得 (fundamentalsのカラム名をDBに合わせて調整)
     if USE_SCALECAT_FILTER:
-        scalecat_list = "', '".join(SCALECAT_TARGETS)
-        query = f"""
+        placeholders = ", ".join("?" * len(SCALECAT_TARGETS))
+        recent_query = f"""
         SELECT p.date, p.code, p.close, f.scalecat, f.coname as company_name
         FROM prices p
-        LEFT JOIN fundamentals f ON p.code = f.code
-        WHERE p.date >= '{start_date}'
-        AND f.scalecat IN ('{scalecat_list}')
-        ORDER BY p.date ASC
+        JOIN fundamentals f ON p.code = f.code
+        WHERE p.date >= ?
+        AND f.scalecat IN ({placeholders})
         """
+        params = [start_date, *SCALECAT_TARGETS]
     else:
-        query = f"SELECT date, code, close FROM prices WHERE date >= '{start_date}' ORDER BY date ASC"
-        
-    df = pd.read_sql(query, conn, parse_dates=['date'])
-    conn.close()
+        recent_query = "SELECT date, code, close FROM prices WHERE date >= ?"
+        params = [start_date]
+    
+    # 移動平均はSQLiteのウィンドウ関数で計算（期間に満たない行はNULL = pandasのrollingと同じ）
+    ma_cte = f"""
+    WITH recent AS ({recent_query}),
+    with_ma AS (
+        SELECT *,
+               CASE WHEN COUNT(close) OVER w_short = 25 THEN AVG(close) OVER w_short END AS ma_short,
+               CASE WHEN COUNT(close) OVER w_long = 75 THEN AVG(close) OVER w_long END AS ma_long
+        FROM recent
+        WINDOW w_short AS (PARTITION BY code ORDER BY date ROWS 24 PRECEDING),
+               w_long AS (PARTITION BY code ORDER BY date ROWS 74 PRECEDING)
+    )
+    """
     
-    if df.empty:
+    # 2. 市場環境判定 (Market Regime)
+    # 最新日のMA75超え銘柄数だけをSQLで集計し、RED（エントリーなし）の日は全件を読み込まない
+    regime_query = ma_cte + """
+    SELECT (SELECT MAX(date) FROM recent) AS latest_date,
+           (SELECT COUNT(DISTINCT code) FROM recent) AS n_codes,
+           COUNT(*) AS n_stocks,
+           COALESCE(SUM(close > ma_long), 0) AS n_bullish
+    FROM with_ma
+    WHERE date = (SELECT MAX(date) FROM recent)
+    """
+    latest_date, n_codes, n_stocks, n_bullish = conn.execute(regime_query, params).fetchone()
+    
+    if latest_date is None:
         print("[ERROR] No data found.")
+        conn.close()
         return
 
-    latest_date = df['date'].max()
+    latest_date = pd.Timestamp(latest_date)
     print(f"[INFO] Latest Data: {latest_date.date()}")
-    print(f"[INFO] Tracked Stocks: {df['code'].nunique()}")
+    print(f"[INFO] Tracked Stocks: {n_codes}")
 
-    # 2. 指標計算
-    print("[INFO] Calculating indicators...")
-    df['ma_short'] = df.groupby('code')['close'].transform(lambda x: x.rolling(25).mean())
-    df['ma_long'] = df.groupby('code')['close'].transform(lambda x: x.rolling(75).mean())
-    
-    # RSI計算
-    df['rsi'] = df.groupby('code')['close'].transform(lambda x: calculate_rsi(x))
-    
-    # トレンド判定
-    df['is_bullish'] = df['close'] > df['ma_long']
-    df['gc_trend'] = df['ma_short'] > df['ma_long']
-    
-    # 3. 市場環境判定 (Market Regime)
-    latest_df = df[df['date'] == latest_date].copy()
-    
-    n_stocks = len(latest_df)
-    n_bullish = latest_df['is_bullish'].sum()
     market_sentiment = n_bullish / n_stocks if n_stocks > 0 else 0
     
     print(f"\n{'='*60}")
@@ -124,8 +158,25 @@ def analyze_market():
         print("[NG] CONDITION: RED (NO ENTRY)")
         print("     Market is weak. Cash is King. Do NOT buy new positions.")
         print(f"{'='*60}")
+        conn.close()
         return
 
+    # 3. 指標計算（GREENの日のみ全件を読み込む）
+    df = pd.read_sql(ma_cte + "SELECT * FROM with_ma ORDER BY date ASC, code ASC", conn,
+                     params=params, parse_dates=['date'])
+    conn.close()
+    # 銘柄コードはカテゴリ型（内部は整数コード）にしてgroupbyで文字列をハッシュしない
+    df['code'] = df['code'].astype('category')
+    
+    print("[INFO] Calculating indicators...")
+    # RSI計算（MA25/MA75は読み込み時にSQLで計算済み）
+    df['rsi'] = calculate_rsi(df['close'], groups=df['code'])
+    
+    # トレンド判定
+    df['gc_trend'] = df['ma_short'] > df['ma_long']
+    
+    latest_df = df[df['date'] == latest_date].copy()
+    
     # 4. シグナル抽出
     latest_df['dip_ratio'] = latest_df['close'] / latest_df['ma_short']
     
@@ -150,38 +201,34 @@ def analyze_market():
     # 候補がある場合
     candidates = candidates.sort_values('dip_ratio')
     
+    # 表示・通知用の派生列は上位20件に対して列単位で計算（行ごとのSeries化をしない）
+    top = candidates.head(20)
+    dip_pct = (top['dip_ratio'] - 1) * 100
+    rsi = top['rsi'].fillna(50.0)
+    
     print(f"Found {len(candidates)} candidates:")
     print("-" * 70)
     print(f"{'Code':<8} {'Close':>12} {'MA25':>12} {'Dip':>10} {'RSI':>8}")
     print("-" * 70)
     
-    for _, row in candidates.head(20).iterrows():
-        dip_pct = (row['dip_ratio'] - 1) * 100
-        rsi_val = row.get('rsi', 50.0)
-        if pd.isna(rsi_val):
-            rsi_val = 50.0
-        print(f"{row['code']:<8} {row['close']:>12,.0f} {row['ma_short']:>12,.0f} {dip_pct:>9.1f}% {rsi_val:>7.1f}")
+    for code, close, ma_short, dip, rsi_val in zip(top['code'], top['close'], top['ma_short'], dip_pct, rsi):
+        print(f"{code:<8} {close:>12,.0f} {ma_short:>12,.0f} {dip:>9.1f}% {rsi_val:>7.1f}")
         
     print(f"{'='*60}")
     
     # --- Google Sheets通知処理 ---
     if ENABLE_SHEETS_NOTIFICATION:
         # データ変換 (DataFrame -> List[Dict])
-        formatted_signals = []
-        for _, row in candidates.head(20).iterrows():
-            rsi_val = row.get('rsi', 50.0)
-            if pd.isna(rsi_val):
-                rsi_val = 50.0
-            formatted_signals.append({
-                'code': str(row['code']),
-                'name': str(row.get('company_name', '')),
-                'current_price': int(row['close']),
-                'ma25_rate': round((row['dip_ratio'] - 1) * 100, 2),
-                'stop_loss': int(row['close'] * (1 - STOP_LOSS_PCT)),
-                'take_profit': int(row['ma_short']),  # 利確目標（MA25）
-                'dip_pct': round((row['dip_ratio'] - 1) * 100, 2),  # news_analyzer用
-                'rsi': round(rsi_val, 1)  # RSI追加
-            })
+        formatted_signals = pd.DataFrame({
+            'code': top['code'].astype(str),
+            'name': top['company_name'].astype(str) if 'company_name' in top else '',
+            'current_price': top['close'].astype(int),
+            'ma25_rate': dip_pct.round(2),
+            'stop_loss': (top['close'] * (1 - STOP_LOSS_PCT)).astype(int),
+            'take_profit': top['ma_short'].astype(int),  # 利確目標（MA25）
+            'dip_pct': dip_pct.round(2),  # news_analyzer用
+            'rsi': rsi.round(1),  # RSI追加
+        }).to_dict(orient='records')
 
         # --- ニュース分析を実行 ---
         try:
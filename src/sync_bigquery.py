@@ -4,102 +4,180 @@ BigQuery Daily Sync Script
 stock_data.dbの直近データをBigQueryに差分同期する。
 全データを上書きするのではなく、直近N日分のみ追加/更新する。
 """
-import sqlite3
-import pandas as pd
+import sys
+import tempfile
+import uuid
 from google.cloud import bigquery
 from pathlib import Path
 from datetime import datetime, timedelta
 
+from src.database import PRICE_COLUMNS, open_readonly
+from src.export_bigquery import BQ_PARTITIONING, write_table_parquet
+
 # --- Config ---
 DB_PATH = Path(__file__).parent.parent / "stock_data.db"
 GCP_PROJECT_ID = "nisa-jquant"
 BQ_DATASET = "stock_data"
 BQ_TABLE_PRICES = "prices"
 SYNC_DAYS = 1  # 直近1日分を同期（前日分）
+TEMP_TABLE_EXPIRATION = timedelta(hours=1)  # 異常終了で残った一時テーブルの自動削除
 
 
-def get_recent_data(db_path: Path, days: int) -> pd.DataFrame:
-    """SQLiteから直近N日分のデータを取得"""
-    conn = sqlite3.connect(db_path)
-    
-    # 直近の日付を取得
-    date_query = f"""
-    SELECT DISTINCT date FROM prices
-    ORDER BY date DESC
-    LIMIT {days}
+def get_recent_dates(conn, days: int) -> list:
+    """SQLiteから直近N営業日の日付を取得（昇順）"""
+    rows = conn.execute(
+        "SELECT DISTINCT date FROM prices ORDER BY date DESC LIMIT ?", (days,)
+    ).fetchall()
+    return sorted(row[0] for row in rows)
+
+
+def write_recent_parquet(conn, dates: list, path: Path) -> int:
     """
-    dates = pd.read_sql(date_query, conn)['date'].tolist()
+    指定日の株価をDataFrameを経由せずParquetに書き出す
     
-    if not dates:
-        conn.close()
-        return pd.DataFrame()
+    全件エクスポートと同じ列型（dateはDATE型）で書き出す。同期先がこの型と一致するのは
+    `python -m src.export_bigquery` で作り直した後のみのため、同期時に check_target_table で確認する。
     
-    # 該当日のデータを取得
-    dates_str = "', '".join(dates)
-    query = f"""
-    SELECT * FROM prices
-    WHERE date IN ('{dates_str}')
+    Returns:
+        int: 書き出した行数
     """
-    df = pd.read_sql(query, conn)
-    conn.close()
+    placeholders = ", ".join("?" * len(dates))
+    return write_table_parquet(
+        conn, BQ_TABLE_PRICES, path, date_columns=("date",),
+        where=f"WHERE date IN ({placeholders})", params=dates
+    )
+
+
+# Parquet(Arrow)型 -> BigQuery型（レガシー名と標準SQL名の両方を同一視する）
+_BQ_TYPES = {"string": "STRING", "double": "FLOAT", "int64": "INTEGER", "date32[day]": "DATE"}
+_BQ_TYPE_ALIASES = {"FLOAT64": "FLOAT", "INT64": "INTEGER"}
+
+
+class TargetSchemaError(RuntimeError):
+    """同期先テーブルが現行の全件エクスポート形式になっていない"""
+
+
+def _parquet_types(parquet_path: Path) -> dict:
+    """Parquetファイルの {列名: BigQuery型}"""
+    import pyarrow.parquet as pq
+    
+    return {
+        column.name: _BQ_TYPES.get(str(column.type), str(column.type).upper())
+        for column in pq.read_schema(parquet_path)
+    }
+
+
+def check_target_table(client, table_id: str, expected_types: dict):
+    """
+    同期先テーブルが現行の全件エクスポート形式か確認（アップロード前に1回だけ実行）
+    
+    旧形式（pandas-gbqで作成、dateがSTRING・パーティションなし）のままでは、
+    DATE型パラメータのDELETEやDATE列のINSERTが型不一致で失敗する。
+    日次同期はテーブルを作り直さないため、ここで検出して中止する。
     
-    return df
+    Args:
+        expected_types: 同期するデータの {列名: BigQuery型}
+    
+    Returns:
+        bigquery.Table: 確認済みの同期先テーブル（replace_dates に渡す）
+    
+    Raises:
+        TargetSchemaError: パーティション設定・列型が同期するデータと一致しない
+    """
+    from google.api_core.exceptions import NotFound
+    
+    try:
+        table = client.get_table(table_id)
+    except NotFound:
+        raise TargetSchemaError(f"{table_id} does not exist")
+    
+    problems = []
+    field, clustering_fields = BQ_PARTITIONING[BQ_TABLE_PRICES]
+    partitioning = table.time_partitioning
+    if partitioning is None or partitioning.field != field or partitioning.type_ != "MONTH":
+        problems.append(f"not MONTH-partitioned on {field}")
+    if table.clustering_fields != clustering_fields:
+        problems.append(f"not clustered on {', '.join(clustering_fields)}")
+    
+    target_types = {f.name: _BQ_TYPE_ALIASES.get(f.field_type, f.field_type) for f in table.schema}
+    for name, expected in expected_types.items():
+        actual = target_types.get(name)
+        if actual != expected:
+            problems.append(f"column {name} is {actual or 'missing'} (expected {expected})")
+    
+    if problems:
+        raise TargetSchemaError(f"{table_id}: " + "; ".join(problems))
+    return table
 
 
-def sync_to_bigquery(df: pd.DataFrame) -> int:
-    """BigQueryに差分データをMERGE（UPSERT）"""
-    if df.empty:
-        return 0
+def sync_to_bigquery(parquet_path: Path, dates: list) -> None:
+    """
+    BigQueryに差分データ（Parquet）を同期（対象日付を置き換え）
     
+    Args:
+        parquet_path: 同期する株価のParquetファイル
+        dates: 同期対象の日付（昇順）。同期先はこの範囲を置き換える
+    
+    Raises:
+        TargetSchemaError: 同期先が `python -m src.export_bigquery` で作り直されていない
+    """
     client = bigquery.Client(project=GCP_PROJECT_ID)
     table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE_PRICES}"
     
-    # 一時テーブルにアップロード
-    temp_table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}._temp_prices_sync"
+    # 旧形式のテーブルには書き込まない（無駄なアップロードをしないよう先に確認）
+    target = check_target_table(client, table_id, _parquet_types(parquet_path))
+    
+    # 一時テーブルにアップロード（同時実行で衝突しないよう実行ごとに別名）
+    temp_table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}._temp_prices_sync_{uuid.uuid4().hex}"
     
     job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
     )
     
-    job = client.load_table_from_dataframe(df, temp_table_id, job_config=job_config)
+    with open(parquet_path, "rb") as f:
+        job = client.load_table_from_file(f, temp_table_id, job_config=job_config)
     job.result()  # 完了を待つ
     
-    # MERGEクエリで差分更新
-    merge_query = f"""
-    MERGE `{table_id}` AS target
-    USING `{temp_table_id}` AS source
-    ON target.date = source.date AND target.code = source.code
-    WHEN MATCHED THEN
-        UPDATE SET
-            open = source.open,
-            high = source.high,
-            low = source.low,
-            close = source.close,
-            volume = source.volume,
-            turnover = source.turnover,
-            adjustmentfactor = source.adjustmentfactor,
-            adjustmentopen = source.adjustmentopen,
-            adjustmenthigh = source.adjustmenthigh,
-            adjustmentlow = source.adjustmentlow,
-            adjustmentclose = source.adjustmentclose,
-            adjustmentvolume = source.adjustmentvolume
-    WHEN NOT MATCHED THEN
-        INSERT (date, code, open, high, low, close, volume, turnover,
-                adjustmentfactor, adjustmentopen, adjustmenthigh, 
-                adjustmentlow, adjustmentclose, adjustmentvolume)
-        VALUES (source.date, source.code, source.open, source.high, 
-                source.low, source.close, source.volume, source.turnover,
-                source.adjustmentfactor, source.adjustmentopen, source.adjustmenthigh,
-                source.adjustmentlow, source.adjustmentclose, source.adjustmentvolume)
+    try:
+        temp_table = client.get_table(temp_table_id)
+        temp_table.expires = datetime.now().astimezone() + TEMP_TABLE_EXPIRATION
+        client.update_table(temp_table, ["expires"])
+        
+        replace_dates(client, target, temp_table_id, dates)
+    finally:
+        # 一時テーブルを削除
+        client.delete_table(temp_table_id, not_found_ok=True)
+
+
+def replace_dates(client, target, temp_table_id: str, dates: list) -> None:
     """
+    対象日付範囲の行を削除してから一時テーブルの行を挿入（1トランザクション）
+    
+    SQLiteの該当日データは毎回全件を送るため、行ごとに比較するMERGEではなく
+    日付範囲ごと置き換える。dateでパーティション分割済みなので削除は該当範囲のみ走査する。
     
-    query_job = client.query(merge_query)
-    result = query_job.result()
+    BEGIN〜COMMITのスクリプトは型不一致でも失敗したクエリジョブとしか見えないため、
+    同期先は check_target_table で確認済みのテーブルを受け取る（ここでは再確認しない）。
     
-    # 一時テーブルを削除
-    client.delete_table(temp_table_id, not_found_ok=True)
+    Args:
+        target: check_target_table の戻り値
+    """
+    table_id = f"{target.project}.{target.dataset_id}.{target.table_id}"
+    columns = ", ".join(PRICE_COLUMNS)
+    replace_query = f"""
+    BEGIN TRANSACTION;
+    DELETE FROM `{table_id}` WHERE date BETWEEN @min_date AND @max_date;
+    INSERT INTO `{table_id}` ({columns})
+    SELECT {columns} FROM `{temp_table_id}`;
+    COMMIT TRANSACTION;
+    """
     
-    return len(df)
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("min_date", "DATE", dates[0]),
+        bigquery.ScalarQueryParameter("max_date", "DATE", dates[-1]),
+    ])
+    client.query(replace_query, job_config=job_config).result()
 
 
 def run_daily_sync():
@@ -116,21 +194,32 @@ def run_daily_sync():
     
     # 1. 直近データを取得
     print(f"[INFO] Loading recent {SYNC_DAYS} days from SQLite...")
-    df = get_recent_data(DB_PATH, SYNC_DAYS)
+    conn = open_readonly(DB_PATH)
+    dates = get_recent_dates(conn, SYNC_DAYS)
     
-    if df.empty:
+    if not dates:
+        conn.close()
         print("[WARN] No recent data found.")
         return
     
-    # 日付範囲を表示
-    dates = sorted(df['date'].unique())
-    print(f"[INFO] Date range: {dates[0]} to {dates[-1]}")
-    print(f"[INFO] Records to sync: {len(df)}")
-    
-    # 2. BigQueryに同期
-    print("[INFO] Syncing to BigQuery (MERGE)...")
-    count = sync_to_bigquery(df)
-    print(f"[INFO] Synced {count} records")
+    with tempfile.TemporaryDirectory() as staging_dir:
+        parquet_path = Path(staging_dir) / "prices_sync.parquet"
+        count = write_recent_parquet(conn, dates, parquet_path)
+        conn.close()
+        
+        # 日付範囲を表示
+        print(f"[INFO] Date range: {dates[0]} to {dates[-1]}")
+        print(f"[INFO] Records to sync: {count}")
+        
+        # 2. BigQueryに同期
+        print("[INFO] Syncing to BigQuery (replace dates)...")
+        try:
+            sync_to_bigquery(parquet_path, dates)
+        except TargetSchemaError as e:
+            print(f"[ERROR] BigQuery prices table is not in the current export format: {e}")
+            print("[ERROR] Run `python -m src.export_bigquery` once to rebuild it, then re-run the sync.")
+            sys.exit(1)
+        print(f"[INFO] Synced {count} records")
     
     print("="*60)
     print("[SUCCESS] Daily sync completed!")
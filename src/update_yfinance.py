@@ -5,29 +5,86 @@ J-Quants解約後、yfinanceを使用して日次株価データを更新する
 既存のDBに追記する形で動作。
 """
 import sqlite3
-import pandas as pd
+import sys
+import threading
 import yfinance as yf
+from collections import deque
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import chain, islice
+from typing import Iterable, Iterator
 from tqdm import tqdm
 import time
 
+from src.database import WRITE_PRAGMAS, code_filter_clause, ensure_scan_indexes, fetch_scalecat_codes
+
 # --- Config ---
 DB_PATH = Path(__file__).parent.parent / "stock_data.db"
-BATCH_SIZE = 20  # 一度に取得する銘柄数（レートリミット対策）
-WAIT_BETWEEN_BATCHES = 3  # バッチ間の待機秒数
+FETCH_WORKERS = 8  # 同時取得数
+# リクエスト開始間隔（全スレッド合計、レートリミット対策）
+# 従来の「20銘柄ごとに3秒待機」と同程度の平均レートを、待機の山を作らず均等に配分する
+REQUEST_INTERVAL = 3 / 20
+# DB上の最終日付を含む直近N日分は取り直す（Yahoo側の訂正・遅れて確定した値で上書きする）
+# 0にすると最終日付の翌日から取得（取り直しなし）
+REFRESH_DAYS = 3
+SCALECAT_TARGETS = ['TOPIX Small 1', 'TOPIX Small 2', 'TOPIX Mid400']
+
+# yfinanceから取得する prices の列
+YF_PRICE_COLUMNS = ("date", "code", "open", "high", "low", "close", "volume")
+# INSERT OR REPLACE（DELETE+INSERT）ではなくその場でUPDATEし、
+# J-Quants由来の turnover / adjustment* 列を消さない
+_UPSERT_PRICES_SQL = (
+    f"INSERT INTO prices ({', '.join(YF_PRICE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(YF_PRICE_COLUMNS))}) "
+    "ON CONFLICT(date, code) DO UPDATE SET "
+    + ", ".join(f"{col}=excluded.{col}" for col in YF_PRICE_COLUMNS[2:])
+)
+
+# 1トランザクションあたりの書き込み行数
+UPSERT_BATCH_SIZE = 10000
+
+
+# DBパスごとの共有接続（銘柄取得・最終日付取得・保存で1本を使い回す）
+_connections = {}
+
+
+def _get_conn(db_path: Path) -> sqlite3.Connection:
+    """
+    共有接続を取得（初回のみ接続してPRAGMAを設定）
+    
+    isolation_level=None（自動コミット）で開き、書き込み時だけ明示的にトランザクションを張る。
+    """
+    key = str(db_path)
+    conn = _connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        for pragma in WRITE_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+        _connections[key] = conn
+    return conn
+
+
+def close_connections() -> None:
+    """共有接続をすべて閉じる"""
+    while _connections:
+        _, conn = _connections.popitem()
+        conn.close()
+
+
+@lru_cache(maxsize=1)
+def _load_target_codes(db_path: Path) -> tuple:
+    """対象銘柄コードをDBから読み込む（プロセス内で1回だけ）"""
+    conn = _get_conn(db_path)
+    ensure_scan_indexes(conn)
+    return tuple(fetch_scalecat_codes(conn, SCALECAT_TARGETS))
 
 
 def get_target_codes(db_path: Path) -> list:
     """fundamentalsテーブルから対象銘柄コードを取得"""
-    conn = sqlite3.connect(db_path)
-    query = """
-    SELECT DISTINCT code FROM fundamentals
-    WHERE scalecat IN ('TOPIX Small 1', 'TOPIX Small 2', 'TOPIX Mid400')
-    """
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df['code'].tolist()
+    return list(_load_target_codes(db_path))
 
 
 def convert_to_yfinance_ticker(code: str) -> str:
@@ -43,8 +100,35 @@ def convert_to_yfinance_ticker(code: str) -> str:
     return f"{code_str}.T"
 
 
+# 全スレッドで共有する次回リクエスト可能時刻
+_rate_lock = threading.Lock()
+_next_request_at = 0.0
+
+
+def _wait_for_slot():
+    """前回のリクエスト開始から REQUEST_INTERVAL 秒空くまで待機"""
+    global _next_request_at
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(now, _next_request_at) + REQUEST_INTERVAL
+    if wait > 0:
+        time.sleep(wait)
+
+
+def to_yfinance_tickers(codes: list) -> list:
+    """銘柄コードのリストをまとめてyfinance形式に変換"""
+    return [convert_to_yfinance_ticker(code) for code in codes]
+
+
 def fetch_single_stock(ticker: str, code: str, start_date: str, end_date: str) -> list:
-    """単一銘柄のデータを取得"""
+    """
+    単一銘柄のデータを取得
+    
+    Returns:
+        list: (date, code, open, high, low, close, volume) のタプルのリスト
+    """
+    _wait_for_slot()
     try:
         stock = yf.Ticker(ticker)
         hist = stock.history(start=start_date, end=end_date)
@@ -52,87 +136,131 @@ def fetch_single_stock(ticker: str, code: str, start_date: str, end_date: str) -
         if hist.empty:
             return []
         
-        results = []
-        for date_idx, row in hist.iterrows():
-            results.append({
-                'date': date_idx.strftime('%Y-%m-%d'),
-                'code': code,
-                'open': float(row.get('Open', 0)),
-                'high': float(row.get('High', 0)),
-                'low': float(row.get('Low', 0)),
-                'close': float(row.get('Close', 0)),
-                'volume': int(row.get('Volume', 0)),
-            })
-        return results
+        # 行ごとにSeries化せず、列単位で変換してからタプルにまとめる（欠損列は0）
+        ohlc = hist.reindex(columns=['Open', 'High', 'Low', 'Close'], fill_value=0).astype(float)
+        volume = hist.reindex(columns=['Volume'], fill_value=0)['Volume'].astype(int)
+        return list(zip(
+            hist.index.strftime('%Y-%m-%d'),
+            [code] * len(hist),
+            ohlc['Open'].tolist(),
+            ohlc['High'].tolist(),
+            ohlc['Low'].tolist(),
+            ohlc['Close'].tolist(),
+            volume.tolist(),
+        ))
     except Exception:
         return []
 
 
-def fetch_yfinance_data(codes: list, start_date: str, end_date: str) -> pd.DataFrame:
+def get_last_dates(db_path: Path, codes: list) -> dict:
+    """
+    銘柄ごとのDB上の最終日付を1回のクエリで取得
+    
+    Returns:
+        dict: {銘柄コード: 最終日付(YYYY-MM-DD)}（株価がない銘柄は含まない）
+    """
+    conn = _get_conn(db_path)
+    code_cond, code_params = code_filter_clause(conn, codes)
+    rows = conn.execute(
+        f"SELECT code, MAX(date) FROM prices WHERE {code_cond} GROUP BY code", code_params
+    ).fetchall()
+    return dict(rows)
+
+
+def fetch_yfinance_data(codes: list, start_date: str, end_date: str, last_dates: dict = None,
+                        refresh_days: int = REFRESH_DAYS) -> Iterator[list]:
     """
-    yfinanceから株価データを取得（1銘柄ずつ安全に取得）
+    yfinanceから株価データを取得（スレッドで並列、リクエスト間隔は共有のスケジューラで制御）
+    
+    全銘柄分をメモリに溜めず、銘柄ごとの結果を取得順に yield する。
     
     Args:
         codes: 銘柄コードリスト（J-Quantsの5桁形式）
         start_date: 開始日 (YYYY-MM-DD)
-        end_date: 終了日 (YYYY-MM-DD)
+        end_date: 終了日 (YYYY-MM-DD、この日は含まない)
+        last_dates: {銘柄コード: DB上の最終日付}。指定時は最終日付の refresh_days 日前以降のみ取得
+        refresh_days: 最終日付を含めて取り直す日数（0なら翌日から取得し、最新の銘柄は取得しない）
     
-    Returns:
-        DataFrame with columns: date, code, open, high, low, close, volume
+    Yields:
+        list: 1銘柄分の (date, code, open, high, low, close, volume) のタプルのリスト
     """
-    all_data = []
     success_count = 0
+    last_dates = last_dates or {}
     
-    for i, code in enumerate(tqdm(codes, desc="Fetching")):
-        ticker = convert_to_yfinance_ticker(code)
-        results = fetch_single_stock(ticker, code, start_date, end_date)
-        
-        if results:
-            all_data.extend(results)
-            success_count += 1
-        
-        # レートリミット対策
-        if (i + 1) % BATCH_SIZE == 0:
-            time.sleep(WAIT_BETWEEN_BATCHES)
+    # 取得済みの日付は直近 refresh_days 日分だけ取り直す（それより前は取得しない）
+    # ティッカーへの変換はループ前に一括で行い、(ticker, code, 開始日) の組で渡す
+    tasks = []
+    for ticker, code in zip(to_yfinance_tickers(codes), codes):
+        last_date = last_dates.get(code)
+        code_start = start_date
+        if last_date:
+            fetch_from = datetime.strptime(last_date, '%Y-%m-%d') + timedelta(days=1 - refresh_days)
+            code_start = max(start_date, fetch_from.strftime('%Y-%m-%d'))
+        if code_start < end_date:
+            tasks.append((ticker, code, code_start))
+    
+    if len(tasks) < len(codes):
+        print(f"[INFO] Skipped {len(codes) - len(tasks)} up-to-date stocks")
     
-    print(f"[INFO] Successfully fetched {success_count}/{len(codes)} stocks")
-    return pd.DataFrame(all_data)
+    def fetch(task):
+        ticker, code, code_start = task
+        return fetch_single_stock(ticker, code, code_start, end_date)
+    
+    # ログファイルへのリダイレクト時（run_daily.bat）はプログレスバーを出さない
+    progress = tqdm(total=len(tasks), desc="Fetching", mininterval=1.0, disable=not sys.stderr.isatty())
+    # HTTP待ちが大半のため、スレッドで並列に取得（結果は銘柄順）
+    # executor.map は全件を先に投入し、未消費の結果を溜め込むため、
+    # 先読みは FETCH_WORKERS * 2 銘柄分までに抑える（メモリは先読み分＋書き込みバッチ分）
+    executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    task_iter = iter(tasks)
+    pending = deque(executor.submit(fetch, task) for task in islice(task_iter, FETCH_WORKERS * 2))
+    try:
+        while pending:
+            future = pending.popleft()
+            next_task = next(task_iter, None)
+            if next_task is not None:
+                pending.append(executor.submit(fetch, next_task))
+            
+            results = future.result()
+            progress.update(1)
+            if results:
+                success_count += 1
+                yield results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        progress.close()
+    
+    print(f"[INFO] Successfully fetched {success_count}/{len(tasks)} stocks")
 
 
-def update_database(df: pd.DataFrame, db_path: Path) -> int:
+def update_database(rows: Iterable[tuple], db_path: Path) -> int:
     """
     DBにデータを追加（UPSERT）
     
+    Args:
+        rows: YF_PRICE_COLUMNS順のタプルのイテラブル（ジェネレータ可、UPSERT_BATCH_SIZE行ずつ消費）
+    
     Returns:
         追加されたレコード数
     """
-    if df.empty:
-        return 0
-    
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    conn = _get_conn(db_path)
+    rows = iter(rows)
     
+    # 行ごとの自動コミットは避けつつ、WALが肥大しないよう UPSERT_BATCH_SIZE 行ごとにコミット
+    # （バッチを揃えてからトランザクションを開始するので、取得待ちの間はロックを持たない）
     count = 0
-    for _, row in df.iterrows():
+    while True:
+        batch = list(islice(rows, UPSERT_BATCH_SIZE))
+        if not batch:
+            break
         try:
-            cursor.execute("""
-                INSERT OR REPLACE INTO prices (date, code, open, high, low, close, volume)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                row['date'],
-                row['code'],
-                row['open'],
-                row['high'],
-                row['low'],
-                row['close'],
-                row['volume']
-            ))
-            count += 1
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.executemany(_UPSERT_PRICES_SQL, batch)
+            count += cursor.rowcount
+            conn.commit()
         except Exception:
-            continue
-    
-    conn.commit()
-    conn.close()
+            conn.rollback()
+            raise
     return count
 
 
@@ -146,6 +274,14 @@ def run_daily_update():
         print(f"[ERROR] Database not found: {DB_PATH}")
         return
     
+    try:
+        _run_daily_update()
+    finally:
+        close_connections()
+
+
+def _run_daily_update():
+    """日次更新の本体（接続のクローズは run_daily_update で行う）"""
     # 1. 対象銘柄を取得
     print("[INFO] Loading target codes from DB...")
     codes = get_target_codes(DB_PATH)
@@ -161,18 +297,17 @@ def run_daily_update():
     
     print(f"[INFO] Fetching: {start_date.strftime('%Y-%m-%d')} -> {end_date.strftime('%Y-%m-%d')}")
     
-    # 3. yfinanceからデータ取得
-    df = fetch_yfinance_data(
+    # 3-4. yfinanceからデータ取得（DBにある日付は直近 REFRESH_DAYS 日分のみ取り直す）し、取得しながらDBに保存
+    last_dates = get_last_dates(DB_PATH, codes)
+    results = fetch_yfinance_data(
         codes,
         start_date.strftime('%Y-%m-%d'),
-        end_date.strftime('%Y-%m-%d')
+        end_date.strftime('%Y-%m-%d'),
+        last_dates=last_dates
     )
+    count = update_database(chain.from_iterable(results), DB_PATH)
     
-    print(f"[INFO] Fetched {len(df)} records")
-    
-    # 4. DBに保存
-    if not df.empty:
-        count = update_database(df, DB_PATH)
+    if count:
         print(f"[INFO] Updated {count} records in database")
     else:
         print("[WARN] No data fetched")
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+pytest共通設定
+
+合成データ（乱数の株価）で高速化したカーネル・SQLを純Pythonの参照実装と突き合わせる。
+test_analyzer.py / test_real_signals.py は実APIを叩く手動実行用スクリプトなので収集しない。
+
+環境変数 DISABLE_NUMBA=1 で numba を読み込ませず、純Pythonのフォールバックで同じテストを実行する。
+"""
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+if os.environ.get("DISABLE_NUMBA") == "1":
+    sys.modules["numba"] = None  # src._njit の ImportError 経路を通す
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+collect_ignore = ["test_analyzer.py", "test_real_signals.py"]
+
+
+def make_prices(n_codes=6, n_days=400, seed=0):
+    """
+    銘柄×営業日の合成株価（ランダムウォーク）を作る
+
+    価格は0.5円刻みに丸め、float32で誤差なく表せる値にする
+    （カーネル側のfloat32変換で参照実装と判定がずれないように）。
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range("2020-01-01", periods=n_days)
+    frames = []
+    for k in range(n_codes):
+        close = 1000 * np.exp(np.cumsum(rng.normal(0.0005, 0.02, n_days)))
+        spread = np.abs(rng.normal(0, 0.01, n_days))
+        frames.append(pd.DataFrame({
+            "date": dates,
+            "code": f"{1300 + k * 10}0",
+            "open": close,
+            "high": close * (1 + spread),
+            "low": close * (1 - spread),
+            "close": close,
+            "volume": rng.integers(1_000, 100_000, n_days).astype(float),
+        }))
+    df = pd.concat(frames, ignore_index=True)
+    price_cols = ["open", "high", "low", "close"]
+    df[price_cols] = (df[price_cols] * 2).round() / 2
+    return df
+
+
+def run_without_numba(test_file, keyword):
+    """numbaを無効にした別プロセスで、指定ファイルのテストを実行して結果を返す"""
+    import subprocess
+    
+    env = {**os.environ, "DISABLE_NUMBA": "1"}
+    return subprocess.run(
+        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", "-W", "error::RuntimeWarning",
+         str(test_file), "-k", keyword],
+        env=env, capture_output=True, text=True,
+    )
+
+
+@pytest.fixture
+def prices():
+    return make_prices()
+
+
+@pytest.fixture
+def price_db(tmp_path, prices):
+    """合成株価を prices テーブルに入れた一時SQLiteファイルのパスを返す"""
+    from src.database import StockDatabase
+
+    db_path = tmp_path / "stock_data.db"
+    db = StockDatabase(str(db_path))
+    db.save_daily_quotes(prices.assign(date=prices["date"].dt.strftime("%Y-%m-%d")))
+    db.close()
+    return db_path
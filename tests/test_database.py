@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+銘柄コードによる prices の絞り込み（code_filter_clause）の回帰テスト
+
+MAX_INLINE_CODES を超える銘柄数で使う一時テーブル small_codes の経路を、
+IN句に展開する経路とPython側での絞り込み（参照実装）と突き合わせる。
+"""
+import sqlite3
+
+import pytest
+
+from conftest import make_prices
+from src import database
+from src.database import StockDatabase, code_filter_clause
+
+N_CODES = database.MAX_INLINE_CODES + 100
+
+
+@pytest.fixture
+def many_codes_db(tmp_path):
+    """MAX_INLINE_CODES を超える銘柄数の一時SQLite（銘柄ごとに数日分）"""
+    prices = make_prices(n_codes=N_CODES, n_days=3)
+    db_path = tmp_path / "stock_data.db"
+    db = StockDatabase(str(db_path))
+    db.save_daily_quotes(prices.assign(date=prices["date"].dt.strftime("%Y-%m-%d")))
+    db.close()
+    return db_path, prices
+
+
+def select_codes(conn, codes, column="p.code"):
+    cond, params = code_filter_clause(conn, codes, column=column)
+    rows = conn.execute(f"SELECT p.date, p.code FROM prices p WHERE {cond} ORDER BY p.date, p.code", params)
+    return rows.fetchall()
+
+
+def reference_rows(prices, codes):
+    """Python側で銘柄を絞り込んだ (date, code) の一覧"""
+    allowed = set(codes)
+    rows = {(d.strftime("%Y-%m-%d"), c) for d, c in zip(prices["date"], prices["code"]) if c in allowed}
+    return sorted(rows)
+
+
+@pytest.mark.parametrize("n_selected", [0, 1, database.MAX_INLINE_CODES, database.MAX_INLINE_CODES + 1, N_CODES])
+def test_code_filter_matches_python_filter(many_codes_db, n_selected):
+    db_path, prices = many_codes_db
+    # 存在しない銘柄コードも混ぜる（一致する行がないだけで結果は変わらない）
+    codes = list(prices["code"].unique()[:n_selected])
+    if codes:
+        codes[-1] = "99990"
+
+    conn = sqlite3.connect(db_path)
+    try:
+        assert select_codes(conn, codes) == reference_rows(prices, codes)
+    finally:
+        conn.close()
+
+
+def test_temp_table_path_matches_inline_path(many_codes_db, monkeypatch):
+    db_path, prices = many_codes_db
+    codes = list(prices["code"].unique()[:-50])
+    conn = sqlite3.connect(db_path)
+    try:
+        cond, params = code_filter_clause(conn, codes, column="p.code")
+        assert "small_codes" in cond and params == []
+        via_temp = select_codes(conn, codes)
+
+        monkeypatch.setattr(database, "MAX_INLINE_CODES", len(codes))
+        cond, params = code_filter_clause(conn, codes, column="p.code")
+        assert "small_codes" not in cond and len(params) == len(codes)
+        inline = select_codes(conn, codes)
+    finally:
+        conn.close()
+    assert via_temp == inline and len(via_temp) > 0
+
+
+def test_temp_table_is_replaced_on_each_call(many_codes_db, monkeypatch):
+    db_path, prices = many_codes_db
+    monkeypatch.setattr(database, "MAX_INLINE_CODES", 0)
+    all_codes = list(prices["code"].unique())
+    conn = sqlite3.connect(db_path)
+    try:
+        select_codes(conn, all_codes)
+        # 2回目の呼び出しでは前回の small_codes が残らない
+        assert select_codes(conn, all_codes[:2]) == reference_rows(prices, all_codes[:2])
+    finally:
+        conn.close()
+
+
+def test_temp_table_path_on_attached_duckdb(tmp_path, monkeypatch):
+    """DuckDBでATTACH + USEした参照専用DBでも一時テーブルを解決できる"""
+    duckdb = pytest.importorskip("duckdb")
+    # sqlite拡張はダウンロードが必要なため、同じATTACH/USE構成のDuckDBファイルで代用する
+    db_path = str(tmp_path / "prices.duckdb")
+    src = duckdb.connect(db_path)
+    src.execute("CREATE TABLE prices (date TEXT, code TEXT)")
+    src.execute("INSERT INTO prices VALUES ('2020-01-01', '13000'), ('2020-01-01', '13010'), ('2020-01-02', '13000')")
+    src.close()
+
+    monkeypatch.setattr(database, "MAX_INLINE_CODES", 0)
+    conn = duckdb.connect()
+    try:
+        conn.execute(f"ATTACH '{db_path}' AS s (READ_ONLY)")
+        conn.execute("USE s")
+        assert select_codes(conn, ["13000"]) == [("2020-01-01", "13000"), ("2020-01-02", "13000")]
+    finally:
+        conn.close()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+シグナル評価（_query_eval_window）の回帰テスト
+
+calculate_performance のSQL集計を、SQL化前の pandas による
+シグナルごとのループ（純Pythonの参照実装）と突き合わせる。
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import evaluate
+
+
+def reference_performance(signals_df, prices_df, eval_days):
+    """SQL化前の calculate_performance と同じ評価ロジック（シグナルごとのループ）"""
+    results = []
+    for _, sig in signals_df.iterrows():
+        code_prices = prices_df[prices_df['code'] == sig['code']]
+        future_prices = code_prices[code_prices['date'] > pd.to_datetime(sig['signal_date'])].head(eval_days)
+        if future_prices.empty:
+            results.append({**sig.to_dict(), 'return_pct': np.nan, 'max_gain': np.nan,
+                            'max_loss': np.nan, 'eval_price': np.nan})
+            continue
+
+        signal_price = sig['signal_price']
+        if signal_price <= 0:
+            signal_price = future_prices.iloc[0]['open']
+        eval_price = future_prices.iloc[-1]['close']
+        results.append({
+            **sig.to_dict(),
+            'return_pct': round((eval_price - signal_price) / signal_price * 100, 2),
+            'max_gain': round((future_prices['high'].max() - signal_price) / signal_price * 100, 2),
+            'max_loss': round((future_prices['low'].min() - signal_price) / signal_price * 100, 2),
+            'eval_price': eval_price,
+        })
+    return pd.DataFrame(results)
+
+
+@pytest.fixture
+def signals(prices):
+    """既存銘柄・存在しない銘柄・データ末尾付近・signal_price<=0 を混ぜたシグナル"""
+    rng = np.random.default_rng(3)
+    n = 200
+    dates = prices['date'].unique()
+    codes = np.append(prices['code'].unique(), '99990')
+    signal_dates = pd.to_datetime(rng.choice(dates, n))
+    signal_dates = signal_dates.append(pd.DatetimeIndex([dates[-3], dates[-1]]))
+    return pd.DataFrame({
+        'code': np.append(rng.choice(codes, n), [codes[0], codes[0]]),
+        'signal_date': signal_dates.strftime('%Y-%m-%d'),
+        'signal_price': np.append(np.where(rng.random(n) < 0.1, 0.0, rng.uniform(500, 1500, n)),
+                                  [1000.0, 1000.0]),
+    })
+
+
+@pytest.mark.parametrize('eval_days', [1, 5, 20])
+def test_reference_eval_window_matches_pandas_loop(price_db, prices, signals, monkeypatch, eval_days):
+    monkeypatch.setattr(evaluate, 'DB_PATH', price_db)
+    actual = evaluate.calculate_performance(signals, eval_days=eval_days)
+    expected = reference_performance(signals, prices, eval_days)
+
+    assert expected['return_pct'].isna().any() and expected['return_pct'].notna().any()
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected, check_exact=False, rtol=1e-12)
+
+
+def test_reference_eval_window_rerun_replaces_signals(price_db, signals):
+    conn = sqlite3.connect(price_db)
+    try:
+        evaluate._query_eval_window(conn, signals, 5, '2099-12-31')
+        window = evaluate._query_eval_window(conn, signals.head(3), 5, '2099-12-31')
+    finally:
+        conn.close()
+    # 再実行で前回の tmp_sig が残らない（3件分だけが集計される）
+    assert set(window['idx']) <= {0, 1, 2}
+
+
+def test_reference_no_prices(price_db, signals, monkeypatch):
+    monkeypatch.setattr(evaluate, 'DB_PATH', price_db)
+    result = evaluate.calculate_performance(signals.assign(code='99990'))
+    assert result['return_pct'].isna().all()
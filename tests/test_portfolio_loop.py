@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+ポートフォリオ日次ループ（_simulate）の回帰テスト
+
+PortfolioBacktester.run_simulation の結果を、カーネル化前の
+日付ごとのDataFrameループ（純Pythonの参照実装）と突き合わせる。
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_prices, run_without_numba
+from src import _njit
+from src import backtest_portfolio as bp
+
+
+def reference_simulation(df):
+    """カーネル化前の run_simulation と同じ売買ロジック（日付ごとのループ）"""
+    cash = bp.INITIAL_CAPITAL
+    positions = {}
+    equity_curve = []
+    trade_log = []
+
+    for current_date, daily_data in df.groupby('date', sort=True):
+        rows = {row.code: row for row in daily_data.itertuples()}
+        market_sentiment = daily_data['is_bullish'].sum() / len(daily_data)
+        allow_entry = market_sentiment >= bp.MARKET_BULLISH_THRESHOLD
+
+        # --- 1. Exit Processing ---
+        for code, pos in list(positions.items()):
+            row = rows.get(code)
+            if row is None:
+                continue
+            pos['highest_price'] = max(pos['highest_price'], row.high)
+            stop_price = pos['entry_price'] * (1 - bp.STOP_LOSS_PCT)
+            trail_price = pos['highest_price'] * (1 - bp.TRAILING_STOP_PCT)
+            exit_trigger_price = max(stop_price, trail_price)
+            if row.low <= exit_trigger_price:
+                revenue = exit_trigger_price * pos['qty']
+                cash += revenue
+                trade_log.append({
+                    'code': code,
+                    'profit': revenue - pos['entry_price'] * pos['qty'],
+                    'return': (exit_trigger_price - pos['entry_price']) / pos['entry_price'],
+                    'entry_date': pos['entry_date'], 'exit_date': current_date,
+                })
+                del positions[code]
+
+        # --- 2. Entry Processing ---
+        open_slots = bp.MAX_POSITIONS - len(positions)
+        if open_slots > 0 and allow_entry and cash > 0:
+            candidates = daily_data[daily_data['entry_signal'] & ~daily_data['code'].isin(positions.keys())]
+            allocation = cash / open_slots
+            for row in candidates.sort_values('priority_score').head(open_slots).itertuples():
+                qty = int(allocation // row.close)
+                if qty > 0:
+                    cash -= qty * row.close
+                    positions[row.code] = {
+                        'entry_price': row.close, 'highest_price': row.close,
+                        'qty': qty, 'entry_date': current_date,
+                    }
+
+        # --- 3. Record Equity ---
+        market_value = 0.0
+        for code, pos in positions.items():
+            row = rows.get(code)
+            price = row.close if row is not None else pos['highest_price']
+            market_value += price * pos['qty']
+        equity_curve.append({'date': current_date, 'equity': cash + market_value})
+
+    return pd.DataFrame(equity_curve), pd.DataFrame(trade_log)
+
+
+@pytest.fixture
+def backtester():
+    """MAX_POSITIONS を超える銘柄数で、歯抜けの日（行の欠損）も含む合成データ"""
+    df = make_prices(n_codes=30, n_days=300, seed=1)
+    rng = np.random.default_rng(2)
+    df = df[rng.random(len(df)) > 0.03]
+    df = df.astype({'code': 'category'}).astype(bp.PRICE_DTYPES)
+
+    bt = bp.PortfolioBacktester.__new__(bp.PortfolioBacktester)
+    bt.df = df.sort_values(['date', 'code']).reset_index(drop=True)
+    bt.calculate_signals()
+    return bt
+
+
+def sort_trades(trades):
+    trades = trades.astype({'code': str})
+    return trades.sort_values(['exit_date', 'code']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('max_positions', [bp.MAX_POSITIONS, 3])
+def test_reference_simulation_matches_dataframe_loop(backtester, monkeypatch, max_positions):
+    # 枠が少ないと候補が空き枠を上回り、優先度による選抜（argpartition）を通る
+    monkeypatch.setattr(bp, 'MAX_POSITIONS', max_positions)
+    equity_df, trades_df = backtester.run_simulation()
+    expected_equity, expected_trades = reference_simulation(backtester.df)
+
+    assert len(expected_trades) > max_positions
+    pd.testing.assert_series_equal(equity_df['date'], expected_equity['date'], check_names=False)
+    np.testing.assert_allclose(equity_df['equity'], expected_equity['equity'], rtol=1e-9)
+
+    expected = sort_trades(expected_trades)
+    actual = sort_trades(trades_df)[expected.columns]
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-9)
+
+
+def test_reference_no_signals_keeps_cash(backtester):
+    backtester.entry_arr[:] = False
+    equity_df, trades_df = backtester.run_simulation()
+    assert trades_df.empty
+    assert (equity_df['equity'] == bp.INITIAL_CAPITAL).all()
+
+
+@pytest.mark.skipif(not _njit.HAS_NUMBA, reason="already running the pure-Python fallback")
+def test_pure_python_fallback():
+    result = run_without_numba(Path(__file__), "reference")
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -2,12 +2,15 @@
 """
 Read signals from Google Sheets and test news_analyzer
 """
+import json
 import sys
+import time
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 sys.stdout.reconfigure(encoding='utf-8')
 
 import gspread
+import pandas as pd
 from google.oauth2.service_account import Credentials
 from src.news_analyzer import batch_analyze, get_nikkei_change
 
@@ -16,26 +19,45 @@ SECRET_KEY_PATH = Path(__file__).parent.parent / "secret_key.json"
 SPREADSHEET_KEY = "1Hejm_UXA3xvn5rEXUhMkpHPtSjM2-foq-t1Su96gGYo"
 SHEET_NAME = "Signals_20260105"
 
+# シートのレコードをローカルにキャッシュ（繰り返し実行時にSheets APIを叩かない）
+CACHE_DIR = Path(__file__).parent.parent / ".cache"
+CACHE_TTL_SEC = 60 * 60  # 1時間
+
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive'
 ]
 
-def main():
-    print("="*60)
-    print("Testing News Analyzer with Real Signals")
-    print("="*60)
+def load_records(spreadsheet_key: str, sheet_name: str) -> list:
+    """
+    シートのレコードを取得（1時間以内のローカルキャッシュがあれば認証ごとスキップ）
+    """
+    cache_path = CACHE_DIR / f"signals_{sheet_name}.json"
+    if cache_path.exists() and time.time() - cache_path.stat().st_mtime < CACHE_TTL_SEC:
+        print(f"[INFO] Using cached records: {cache_path}")
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
     
-    # 1. Google Sheets認証
     print("[INFO] Connecting to Google Sheets...")
     creds = Credentials.from_service_account_file(str(SECRET_KEY_PATH), scopes=SCOPES)
     client = gspread.authorize(creds)
+    sh = client.open_by_key(spreadsheet_key)
+    records = sh.worksheet(sheet_name).get_all_records()
     
-    # 2. シートからデータ取得
+    CACHE_DIR.mkdir(exist_ok=True)
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+    return records
+
+
+def main():
+    print("="*60)
+    print("Testing News Analyzer with Real Signals")
+    print("="*60)
+    
+    # 1-2. シートからデータ取得（Google Sheets認証はキャッシュが無い場合のみ）
     try:
-        sh = client.open_by_key(SPREADSHEET_KEY)
-        worksheet = sh.worksheet(SHEET_NAME)
-        records = worksheet.get_all_records()
+        records = load_records(SPREADSHEET_KEY, SHEET_NAME)
         print(f"[INFO] Loaded {len(records)} signals from {SHEET_NAME}")
     except Exception as e:
         print(f"[ERROR] Failed to load sheet: {e}")
@@ -46,18 +68,25 @@ def main():
         return
     
     # 3. シグナルデータを変換
-    signals = []
-    for row in records[:20]:  # 20銘柄すべて
-        code = str(row.get('銘柄コード', row.get('code', '')))
-        name = str(row.get('銘柄名', row.get('name', '')))
-        ma25_rate = row.get('MA25乖離率(%)', row.get('ma25_rate', 0))
-        
-        if code and name:
-            signals.append({
-                'code': code,
-                'name': name,
-                'dip_pct': float(ma25_rate) if ma25_rate else -3.0
-            })
+    # 行ごとの .get() ではなく、DataFrame化して列単位で変換する
+    # 数値変換は後で明示的に行う（欠損があっても銘柄コードを float にしない）
+    records_df = pd.DataFrame(records[:20], dtype=object)  # 20銘柄すべて
+    
+    def column(primary, fallback):
+        """日本語ヘッダーを優先し、値が無い行だけ英語ヘッダーの値で補う（列の並び順に依存しない）"""
+        empty = pd.Series([None] * len(records_df), index=records_df.index, dtype=object)
+        values = records_df.get(primary, empty)
+        return values.combine_first(records_df.get(fallback, empty))
+    
+    df = pd.DataFrame({
+        'code': column('銘柄コード', 'code'),
+        'name': column('銘柄名', 'name'),
+        'dip_pct': column('MA25乖離率(%)', 'ma25_rate'),
+    })
+    df[['code', 'name']] = df[['code', 'name']].fillna('').astype(str)
+    dip_pct = pd.to_numeric(df['dip_pct'], errors='coerce')
+    df['dip_pct'] = dip_pct.mask(dip_pct == 0).fillna(-3.0)
+    signals = df[(df['code'] != '') & (df['name'] != '')].to_dict('records')
     
     print(f"[INFO] Testing {len(signals)} signals:")
     for s in signals:
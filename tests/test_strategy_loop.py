@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+戦略カーネル（_run_one / _run_grid / _run_all）の回帰テスト
+
+NisaJQuantBacktester.run_strategy_grid の結果を、カーネル化前の
+iterrows による売買ロジック（純Pythonの参照実装）と突き合わせる。
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import run_without_numba
+from src import _njit
+from src.backtest import NisaJQuantBacktester
+
+PARAM_GRID = [
+    {'dip_threshold': 0.98, 'stop_loss': 0.10, 'trailing_stop': 0.15},
+    {'dip_threshold': 0.97, 'stop_loss': 0.08, 'trailing_stop': 0.12},
+    {'dip_threshold': 0.98, 'stop_loss': 0.05, 'trailing_stop': 0.10},
+    {'dip_threshold': 0.95, 'stop_loss': 0.12, 'trailing_stop': 0.20},
+]
+
+
+def reference_strategy(df, params):
+    """カーネル化前の run_strategy と同じ売買ロジック（銘柄ごと・行ごとのループ）"""
+    trades = []
+    dip_threshold = params['dip_threshold']
+    stop_loss_pct = params['stop_loss']
+    trailing_stop_pct = params['trailing_stop']
+
+    for code, sub_df in df.groupby('code', observed=True):
+        position = None
+        for row in sub_df.sort_values('date').itertuples():
+            if pd.isna(row.ma_short) or pd.isna(row.ma_long):
+                continue
+            if position is None:
+                if row.gc_trend and row.close < row.ma_short * dip_threshold:
+                    position = (row.date, row.close)
+                    high_since_entry = row.close
+                continue
+
+            high_since_entry = max(high_since_entry, row.high)
+            entry_date, entry_price = position
+            if row.low <= entry_price * (1 - stop_loss_pct):
+                exit_price, reason = entry_price * (1 - stop_loss_pct), 'StopLoss'
+            elif row.low <= high_since_entry * (1 - trailing_stop_pct):
+                exit_price, reason = high_since_entry * (1 - trailing_stop_pct), 'Trailing'
+            else:
+                continue
+            trades.append({
+                'code': str(code), 'entry_date': entry_date, 'exit_date': row.date,
+                'entry_price': entry_price, 'exit_price': exit_price,
+                'return': (exit_price - entry_price) / entry_price, 'reason': reason,
+            })
+            position = None
+
+    return pd.DataFrame(trades)
+
+
+@pytest.fixture
+def indicators(prices):
+    bt = NisaJQuantBacktester.__new__(NisaJQuantBacktester)
+    df = bt.calculate_indicators(prices.astype({'code': 'category'}))
+    # カーネルはfloat32で受け取るため、参照側も同じ値から判定する
+    cols = ['close', 'high', 'low', 'ma_short', 'ma_long']
+    df[cols] = df[cols].astype(np.float32).astype(np.float64)
+    df['gc_trend'] = df['ma_short'] > df['ma_long']
+    return bt, df
+
+
+def sort_trades(trades):
+    trades = trades.astype({'code': str})
+    return trades.sort_values(['code', 'entry_date']).reset_index(drop=True)
+
+
+def test_reference_grid_matches_iterrows_logic(indicators):
+    bt, df = indicators
+    grid = bt.run_strategy_grid(df, PARAM_GRID)
+
+    for param_id, params in enumerate(PARAM_GRID):
+        expected = sort_trades(reference_strategy(df, params))
+        actual = sort_trades(grid[grid['param_id'] == param_id].drop(columns='param_id'))
+        assert len(expected) > 0
+        pd.testing.assert_frame_equal(actual[expected.columns], expected, check_exact=False, rtol=1e-12)
+
+
+def test_reference_single_param_matches_grid(indicators):
+    bt, df = indicators
+    single = bt.run_strategy(df, PARAM_GRID[1])
+    grid = bt.run_strategy_grid(df, PARAM_GRID)
+    from_grid = grid[grid['param_id'] == 1].drop(columns='param_id')
+    pd.testing.assert_frame_equal(sort_trades(single), sort_trades(from_grid))
+
+
+def test_reference_accepts_string_codes(indicators):
+    bt, df = indicators
+    expected = bt.run_strategy(df, PARAM_GRID[0])
+    actual = bt.run_strategy(df.astype({'code': str}), PARAM_GRID[0])
+    pd.testing.assert_frame_equal(sort_trades(actual), sort_trades(expected))
+
+
+def test_reference_empty_frame():
+    bt = NisaJQuantBacktester.__new__(NisaJQuantBacktester)
+    assert bt.run_strategy_grid(pd.DataFrame(), PARAM_GRID).empty
+
+
+@pytest.mark.skipif(not _njit.HAS_NUMBA, reason="already running the pure-Python fallback")
+def test_pure_python_fallback():
+    result = run_without_numba(Path(__file__), "reference")
+    assert result.returncode == 0, result.stdout + result.stderr